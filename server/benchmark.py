@@ -0,0 +1,355 @@
+'''
+ _   _      _          _____
+| \ | |    | |        |_   _|
+|  \| | ___| |___      _| |
+| . ` |/ _ \ __\ \ /\ / / |
+| |\  |  __/ |_ \ V  V /| |_
+|_| \_|\___|\__| \_/\_/_____|
+
+Introduction to computer networking and Internet
+================================================
+Benchmarks of the directory service
+'''
+import threading
+import tempfile
+import logging
+import shutil
+import socket
+import time
+import re
+
+import parsing as p
+from directory import Directory,DirectoryClient,AsyncDirectoryClient,S_CLOSED
+from protocol import ProtocolWrapper
+from eventloop import EventLoop
+from journal import Journal,SYNC_POLICIES
+
+
+class LockedDirectory:
+    """
+    Reference implementation of the previous read path, in which
+    queries build the result while holding the directory lock
+    """
+
+    def __init__(self):
+        self.__directory=dict()
+        self.__directory_lock=threading.Lock()
+
+    def directory_register(self,username,address,port):
+        self.__directory_lock.acquire()
+        self.__directory[username]=(address,port)
+        self.__directory_lock.release()
+
+    def directory_deregister(self,username):
+        self.__directory_lock.acquire()
+        if username in self.__directory:
+            self.__directory.pop(username)
+        self.__directory_lock.release()
+
+    def directory_query(self,username=None):
+        res=[]
+        self.__directory_lock.acquire()
+        if username!=None and username in self.__directory:
+            res.append((username,self.__directory[username][0],self.__directory[username][1]))
+        elif username==None:
+            res+=[(key,value[0],value[1]) for key,value in self.__directory.items()]
+        self.__directory_lock.release()
+        return res
+
+
+def bench_query(directory,users,readers,writers,duration):
+    """
+    Run reader threads listing the whole directory while writer
+    threads keep registering and deregistering users.
+    Returns the number of queries and writes per second.
+    """
+    for i in xrange(users):
+        directory.directory_register("user%d"%i,"127.0.0.1",1024+i%60000)
+
+    queries=[0]*readers
+    writes=[0]*writers
+    running=[True]
+
+    def reader(n):
+        while running[0]:
+            directory.directory_query()
+            queries[n]+=1
+
+    def writer(n):
+        i=0
+        while running[0]:
+            username="churn%d_%d"%(n,i%100)
+            directory.directory_register(username,"127.0.0.1",2000+i%100)
+            directory.directory_deregister(username)
+            writes[n]+=2
+            i+=1
+
+    threads=[threading.Thread(target=reader,args=(n,)) for n in range(readers)]
+    threads+=[threading.Thread(target=writer,args=(n,)) for n in range(writers)]
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    running[0]=False
+    for t in threads:
+        t.join()
+
+    return sum(queries)/float(duration),sum(writes)/float(duration)
+
+
+def directory_suite(values):
+    print "QUERY throughput, %d users, %d readers, %d writers, %ds"%(values.users,values.readers,values.writers,values.duration)
+    for name,cls in (("locked",LockedDirectory),("snapshot",Directory)):
+        q,w=bench_query(cls(),values.users,values.readers,values.writers,values.duration)
+        print "%-10s %12.0f queries/s %12.0f writes/s"%(name,q,w)
+
+
+def bench_result(directory,duration,cached):
+    """
+    Encode the payload of a full listing over and over, either
+    formatting every entry as before or through the cached payload.
+    Returns the number of payloads per second.
+    """
+    count=0
+    started=time.time()
+    while time.time()-started<duration:
+        if cached:
+            directory.directory_result()
+        else:
+            "\n".join(["%s,%s,%d"%i for i in directory.directory_query()])
+        count+=1
+    return count/(time.time()-started)
+
+
+def result_suite(values):
+    directory=Directory()
+    for i in xrange(values.users):
+        directory.directory_register("user%d"%i,"127.0.0.1",1024+i%60000)
+
+    print "RESULT payload encoding, %d users (%d bytes), %ds"%(values.users,len(directory.directory_result()),values.duration)
+    for name,cached in (("formatted",False),("cached",True)):
+        r=bench_result(directory,values.duration,cached)
+        print "%-10s %12.0f payloads/s"%(name,r)
+
+
+class RegexMessage(p.Message):
+    """
+    Reference implementation of the previous header parser, based
+    on a regular expression matched against every message
+    """
+
+    def parse(self,buf):
+        consumed=0
+        match=re.match("(?P<type>\w+) (?P<len>\d+)(?P<args>( \S+)*)\n",buf)
+        if match:
+            hlen=match.end()
+            m_type=match.groupdict()["type"]
+            m_len=int(match.groupdict()["len"])
+            m_args=[i for i in match.groupdict()["args"].strip().split(" ") if len(i)>0]
+            if len(buf)>=hlen+m_len:
+                consumed=hlen+m_len
+                self.type=m_type
+                self.args=m_args
+                self.payload=buf[hlen:hlen+m_len]
+        return consumed
+
+
+def bench_parse(cls,buf,duration):
+    """
+    Parse the same encoded message over and over.
+    Returns the number of messages per second.
+    """
+    count=0
+    started=time.time()
+    while time.time()-started<duration:
+        for i in xrange(1000):
+            cls().parse(buf)
+        count+=1000
+    return count/(time.time()-started)
+
+
+def parse_suite(values):
+    messages=[("header only",p.Message(p.T_PING)),
+              ("small chat",p.Message(p.T_MESSAGE,["alice"],"hello bob, how are you today?")),
+              ("large payload",p.Message(p.T_RESULT,[],"x"*65536))]
+
+    print "Message parsing, %ds"%values.duration
+    for name,m in messages:
+        buf=str(m)
+        r=bench_parse(RegexMessage,buf,values.duration)
+        s=bench_parse(p.Message,buf,values.duration)
+        print "%-14s %12.0f msgs/s regex %12.0f msgs/s split (x%.2f)"%(name,r,s,s/r)
+
+
+def bench_transport(directory,event,nodelay,requests,duration):
+    """
+    Serve one client either from a DirectoryClient thread or from
+    an AsyncDirectoryClient on an event loop, and send it batches
+    of pipelined requests, waiting for all the answers each time.
+    Returns the number of answers per second and the outgoing
+    traffic counters of the session.
+    """
+    ProtocolWrapper.NODELAY=AsyncDirectoryClient.NODELAY=nodelay
+
+    listener=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1",0))
+    listener.listen(1)
+    client=socket.create_connection(listener.getsockname())
+    clisock,addr=listener.accept()
+    listener.close()
+
+    if event:
+        loop=EventLoop()
+        session=AsyncDirectoryClient(loop,directory,clisock,addr)
+        server=threading.Thread(target=loop.run)
+    else:
+        session=server=DirectoryClient(directory,clisock,addr)
+    server.start()
+
+    decoder=p.StreamDecoder()
+    def exchange(messages):
+        client.sendall("".join([str(m) for m in messages]))
+        answers=0
+        while answers<len(messages):
+            answers+=len(decoder.feed(client.recv(65536)))
+
+    exchange([p.Message(p.T_USER,["bench"]),p.Message(p.T_PASS,["bench"])])
+    count=0
+    started=time.time()
+    while time.time()-started<duration:
+        exchange(requests)
+        count+=len(requests)
+    elapsed=time.time()-started
+    client.close()
+
+    if event:
+        while session.state!=S_CLOSED:
+            time.sleep(0.01)
+        loop.call_from_thread(loop.stop)
+    server.join()
+
+    return count/elapsed,session.stats
+
+
+def transport_suite(values):
+    directory=Directory()
+    for i in xrange(1000):
+        directory.directory_register("user%d"%i,"127.0.0.1",1024+i)
+
+    workloads=[("full listing",[p.Message(p.T_QUERY)]),
+               ("16 pipelined",[p.Message(p.T_QUERY,["user%d"%i]) for i in range(16)])]
+
+    print "Directory session transport, %d byte listing, %ds"%(len(directory.directory_result()),values.duration)
+    for event in (False,True):
+        for name,requests in workloads:
+            for nodelay in (False,True):
+                r,stats=bench_transport(directory,event,nodelay,requests,values.duration)
+                print "%-9s %-13s %-8s %10.0f answers/s %8.1f bytes/answer %6.2f sends/answer"%(
+                    "event" if event else "threaded",name,"nodelay" if nodelay else "nagle",r,
+                    stats.bytes/float(max(stats.messages,1)),stats.syscalls/float(max(stats.messages,1)))
+
+
+def bench_journal(sync,writers,duration):
+    """
+    Run writer threads registering and deregistering users on a
+    directory journaled with the given fsync policy, or not journaled
+    if sync is None. Returns the number of writes per second and the
+    number of fsyncs per second.
+    """
+    path=tempfile.mkdtemp(prefix="journal")
+    try:
+        journal=Journal(path,sync) if sync!=None else None
+        directory=Directory(journal=journal)
+
+        writes=[0]*writers
+        running=[True]
+
+        def writer(n):
+            i=0
+            while running[0]:
+                username="churn%d_%d"%(n,i%100)
+                directory.directory_register(username,"127.0.0.1",2000+i%100)
+                directory.directory_deregister(username)
+                writes[n]+=2
+                i+=1
+
+        threads=[threading.Thread(target=writer,args=(n,)) for n in range(writers)]
+        started=time.time()
+        for t in threads:
+            t.start()
+        time.sleep(duration)
+        running[0]=False
+        for t in threads:
+            t.join()
+        elapsed=time.time()-started
+
+        directory.directory_close()
+        return sum(writes)/elapsed,(journal.fsyncs if journal!=None else 0)/elapsed
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_recovery(entries,tail):
+    """
+    Write a snapshot of entries users followed by a journal of tail
+    changes, then start a directory from them. Returns the recovery
+    time measured by the journal, the time until the directory is
+    ready, and the number of users recovered.
+    """
+    path=tempfile.mkdtemp(prefix="journal")
+    try:
+        names=["user%07d"%i for i in xrange(entries)]
+        snapshot=dict((username,(username,"10.0.%d.%d"%(i/250%250,i%250),1024+i%60000)) for i,username in enumerate(names))
+        journal=Journal(path)
+        journal.write_snapshot(1,names,snapshot)
+        del snapshot
+
+        #the changes made after the snapshot, half of the users leaving
+        journal.recover()
+        for i in xrange(tail):
+            username="user%07d"%(i*7%max(entries,1))
+            journal.append([(username,None if i%2 else (username,"10.1.0.1",4000+i%1000))])
+        journal.close()
+
+        started=time.time()
+        journal=Journal(path)
+        directory=Directory(journal=journal)
+        ready=time.time()-started
+        recovered=len(directory.directory_query())
+        directory.directory_close()
+        return journal.recovery_time,ready,recovered
+    finally:
+        shutil.rmtree(path)
+
+
+def journal_suite(values):
+    print "Journaled REGISTER/DEREGISTER throughput, %d writers, %ds"%(values.writers,values.duration)
+    for sync in (None,)+SYNC_POLICIES:
+        w,f=bench_journal(sync,values.writers,values.duration)
+        print "%-10s %12.0f writes/s %10.0f fsyncs/s"%(sync or "no journal",w,f)
+
+    print "Recovery of %d entries and %d journal records"%(values.entries,values.tail)
+    recovery,ready,recovered=bench_recovery(values.entries,values.tail)
+    print "%d users recovered in %.3fs, directory ready in %.3fs"%(recovered,recovery,ready)
+
+
+if __name__=="__main__":
+    from optparse import OptionParser
+
+    op=OptionParser()
+    op.add_option("-u","--users",dest="users",type="int",default=10000,help="Number of registered users")
+    op.add_option("-r","--readers",dest="readers",type="int",default=4,help="Number of querying threads")
+    op.add_option("-w","--writers",dest="writers",type="int",default=2,help="Number of register/deregister threads")
+    op.add_option("-d","--duration",dest="duration",type="int",default=3,help="Duration of each run in seconds")
+    op.add_option("-e","--entries",dest="entries",type="int",default=1000000,help="Number of users in the recovered snapshot")
+    op.add_option("-t","--tail",dest="tail",type="int",default=10000,help="Number of journal records replayed after the snapshot")
+    op.add_option("-s","--suite",dest="suite",type="choice",choices=["all","directory","result","parse","transport","journal"],default="all",help="Benchmark suite to run")
+
+    (values,args)=op.parse_args()
+
+    #keep the directory logs out of the measurements
+    logging.disable(logging.CRITICAL)
+
+    suites=[("directory",directory_suite),("result",result_suite),("parse",parse_suite),("transport",transport_suite),("journal",journal_suite)]
+    for name,suite in suites:
+        if values.suite in ("all",name):
+            suite(values)
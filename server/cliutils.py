@@ -71,3 +71,36 @@ def setup_logging(verbose=True,logfile=None):
     handler.setFormatter(formatter)
     l.addHandler(handler)
 
+
+
+def raise_fd_limit():
+    """
+    Raise the soft limit on open file descriptors up to the hard
+    limit. Servers holding one socket per client hit the default
+    soft limit (usually 1024) long before any other resource.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    try:
+        soft,hard=resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft<hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE,(hard,hard))
+    except (ValueError,resource.error):
+        pass
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def load_secret(path,size=32):
+    """
+    Read a secret from a file, creating the file with random
+    bytes, readable by the owner only, if it does not exist yet
+    """
+    if not os.path.exists(path):
+        fd=os.open(path,os.O_WRONLY|os.O_CREAT|os.O_EXCL,0600)
+        os.write(fd,os.urandom(size))
+        os.close(fd)
+    with open(path,"rb") as f:
+        return f.read()
@@ -14,95 +14,564 @@ Eurechat directory service
 import threading
 import logging
 import socket
+import errno
+import heapq
+import bisect
+import Queue
+import hashlib
+import hmac
+import time
+import gc
 import os
 
+from collections import deque
+
 import parsing as p
-from protocol import ProtocolWrapper
+from protocol import ProtocolWrapper,TransportStats,totals
+from eventloop import EventLoop,EV_READ,EV_WRITE
+from journal import Journal,JournalError,SYNC_POLICIES,SYNC_GROUP
+
+#states of the event driven directory sessions
+S_USER="USER_EXPECTED"
+S_PASS="PASS_EXPECTED"
+S_AUTHENTICATED="AUTHENTICATED"
+S_CLOSED="CLOSED"
+
+#default and largest number of users in a page of the listing
+PAGE_SIZE=100
+MAX_PAGE_SIZE=1000
+
+
+def valid_username(username):
+    """
+    Usernames can't contain "=", which tells the arguments of a page
+    query apart from a username to look up, nor ",", which separates
+    the fields of the listings and of the journal records
+    """
+    return len(username)>0 and "=" not in username and "," not in username
+
+
+def parse_page_query(args):
+    """
+    QUERY arguments of the form key=value ask for one page of the
+    listing: prefix=<start of the usernames>, after=<cursor returned
+    with the previous page> and limit=<page size>. Returns the tuple
+    of directory_page arguments, or None for the plain QUERY forms.
+    Raises a ValueError if the page query is malformed.
+    """
+    if len(args)==0 or "=" not in args[0]:
+        return None
+
+    options=dict()
+    for a in args:
+        key,separator,value=a.partition("=")
+        if not separator or key not in ("prefix","after","limit"):
+            raise ValueError("unexpected argument %s"%a)
+        options[key]=value
+    limit=options.get("limit",str(PAGE_SIZE))
+    if not limit.isdigit():
+        raise ValueError("invalid limit %s"%limit)
+    return (options.get("prefix",""),options.get("after") or None,max(1,min(int(limit),MAX_PAGE_SIZE)))
+
+
+def encode_changes(changes):
+    """
+    Encode a dict mapping usernames to their (username,address,port)
+    entry, or to None for the users that left, as the payload of SYNC
+    deltas and NOTIFY messages
+    """
+    return "\n".join([("+%s,%s,%d"%entry if entry!=None else "-%s"%username) for username,entry in changes.iteritems()])
+
+
+class Probe:
+    """
+    Non blocking PING/PONG exchange with a registered user, bounded
+    by a deadline. Once the exchange completes, fails or runs out of
+    time, the callback is invoked with the probe itself; error is None
+    on success or a string describing the failure.
+    """
+
+    def __init__(self,loop,username,address,deadline,callback):
+        self.username=username
+        self.address=address
+        self.error=None
+
+        self.__loop=loop
+        self.__callback=callback
+        self.__decoder=p.StreamDecoder()
+        self.__outbuf=str(p.Message(p.T_PING))
+        self.__connected=False
+        self.__timer=None
+        self.__sock=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self.__sock.setblocking(0)
+        self.__fd=self.__sock.fileno()
+
+        try:
+            err=self.__sock.connect_ex(address)
+        except socket.error,e:
+            err=e.args[0]
+
+        if err in (0,errno.EINPROGRESS,errno.EWOULDBLOCK):
+            self.__loop.register(self,EV_WRITE)
+            self.__timer=self.__loop.call_later(deadline,self.__done,"no PONG within %ss"%deadline)
+        else:
+            self.__loop.call_later(0,self.__done,"connect failed (%s)"%errno.errorcode.get(err,err))
+
+    def fileno(self):
+        return self.__fd
+
+    def handle_write(self):
+        if not self.__connected:
+            #first writable event, the connection attempt completed
+            err=self.__sock.getsockopt(socket.SOL_SOCKET,socket.SO_ERROR)
+            if err!=0:
+                return self.__done("connect failed (%s)"%errno.errorcode.get(err,err))
+            self.__connected=True
+
+        try:
+            sent=self.__sock.send(self.__outbuf)
+        except socket.error,e:
+            return self.__done("send error: %s"%str(e))
+
+        self.__outbuf=self.__outbuf[sent:]
+        if not self.__outbuf:
+            #the ping is out, wait for the pong
+            self.__loop.modify(self,EV_READ)
+
+    def handle_read(self):
+        try:
+            data=self.__sock.recv(1024)
+        except socket.error,e:
+            return self.__done("receive error: %s"%str(e))
+
+        if not data:
+            return self.__done("no PONG received")
+
+        try:
+            msgs=self.__decoder.feed(data)
+        except p.ParseError,e:
+            return self.__done(str(e))
+        if msgs:
+            self.__done(None if msgs[0].type==p.T_PONG else "no PONG received")
+
+    def handle_close(self):
+        self.__done("connection error")
+
+    def __done(self,error):
+        if self.__callback==None:
+            return
+        if self.__timer!=None:
+            self.__timer.cancel()
+        self.__loop.unregister(self)
+        self.__sock.close()
+
+        self.error=error
+        callback,self.__callback=self.__callback,None
+        callback(self)
 
 
 class DirectoryChecker(threading.Thread):
     """
     This thread is used to verify the proper behavior
-    of all the clients registered to the directory
+    of all the clients registered to the directory.
+    Users are probed concurrently from a private event loop,
+    at most max_probes at a time, and every probe is bounded
+    by PROBE_DEADLINE seconds. Every probe holds a file descriptor,
+    see probe_limit for a number of probes derived from their limit.
+    A probe that can't get one waits for the running probes to
+    complete, or fails without deregistering the user if none runs.
+    In in-band mode, users with an open directory session are
+    instead sent a PING over that session at every loop, and
+    dropped once KEEPALIVE_MISSED of them are left unanswered.
+    When the directory grants leases, nobody is probed: every
+    EXPIRY_TICK seconds the expired leases are evicted.
     """
     LOOP_WAIT = 10
+    PROBE_DEADLINE = 5
+    MAX_PROBES = 256
+    KEEPALIVE_MISSED = 2
+    EXPIRY_TICK = 1
     
-    def __init__(self,directory):
+    def __init__(self,directory,inband=False,max_probes=MAX_PROBES):
         """
-        The constructor takes as input the directory object
+        The constructor takes as input the directory object, whether
+        open sessions should be used for keepalives, and the number
+        of users that can be probed at the same time
         """
         threading.Thread.__init__(self)
         self.daemon=True
         
         self.__directory=directory
+        self.__inband=inband
+        self.__max_probes=max_probes
         self.__logger=logging.getLogger("checker")
+
+        self.__loop=EventLoop()
+        #users still to be probed, and number of probes in flight
+        self.__queue=deque()
+        self.__running=0
+        self.__failed=0
+        #probes that had to wait for a file descriptor
+        self.__delayed=0
+        #duration of the last sweep, in seconds
+        self.last_sweep=None
         
+    @staticmethod
+    def probe_limit(fd_limit):
+        """
+        Number of concurrent probes for a process allowed fd_limit
+        file descriptors: half of them, the other half being left to
+        the sessions
+        """
+        if fd_limit==None:
+            return DirectoryChecker.MAX_PROBES
+        return max(1,fd_limit/2)
+
     def run(self):
         """
         Continuously verify for the correct operation of the registered
         clients
         """
-        import time
-        
         while True:
+            if self.__directory.lease_ttl!=None:
+                time.sleep(DirectoryChecker.EXPIRY_TICK)
+                self.expire()
+                continue
+
             #sleep for a while at every loop
             time.sleep(DirectoryChecker.LOOP_WAIT)
-            
-            #generate the list of registered users
-            users=[i[0] for i in self.__directory.directory_query()]
-            self.__logger.debug("%d users are active"%len(users))
-            
-            for username in users:
-                #retrieve the bind information for each user
-                res=self.__directory.directory_query(username)
-                username,address,port=res[0] if len(res)==1 else (username,None,None)
-                
-                if address!=None and port!=None:
-                    try:
-                        self.__logger.debug("connecting to %s:%d"%(address,port))
-                        sock=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-                        sock.connect((address,port))
-
-                        #use the protocol wrapper to simplify socket handling
-                        proto=ProtocolWrapper(sock,(address,port))
-                        #send a ping, and wait for a pong
-                        self.__logger.debug("sending ping")
-                        proto.send(p.T_PING)
-
-                        msg=proto.recv()
-                        
-                        
-                        if msg!=None and msg.type==p.T_PONG:
-                            self.__logger.info("USER %s OK"%username)
-                            proto.close()
-                        else:
-                            raise Exception, "no PONG received"
-                        
-                    except Exception,e:
-                        #client is misbehaving, deregister it
-                        self.__logger.error("USER %s ERROR (%s)"%(username,str(e)))
-                        self.__directory.directory_deregister(username)
+            self.sweep()
+
+    def expire(self):
+        """
+        Evict the users whose lease has expired. The cost depends
+        on the number of expired leases, not on the number of users.
+        """
+        expired=self.__directory.directory_expire(callback=self.__saved)
+        for username in expired:
+            self.__logger.error("USER %s ERROR (lease expired)"%username)
+        return expired
+
+    def sweep(self):
+        """
+        Probe all the registered users once. Returns the duration
+        of the sweep, which is bounded by PROBE_DEADLINE per batch
+        of max_probes users rather than by the number of users.
+        """
+        started=time.time()
+
+        #generate the list of registered users
+        users=self.__directory.directory_query()
+        total=len(users)
+        self.__running=0
+        self.__failed=0
+        self.__delayed=0
+        self.__logger.debug("%d users are active"%total)
+
+        if self.__inband:
+            #users with an open session do not need a dial-back probe
+            sessions=dict(self.__directory.directory_sessions())
+            self.__keepalive(sessions)
+            users=[u for u in users if u[0] not in sessions]
+
+        self.__queue=deque(users)
+
+        self.__start_probes()
+        if self.__running>0:
+            self.__loop.run()
+
+        self.last_sweep=time.time()-started
+        self.__logger.info("sweep of %d users completed in %.3fs, %d failed"%(total,self.last_sweep,self.__failed))
+        if self.last_sweep>DirectoryChecker.LOOP_WAIT:
+            self.__logger.warning("sweep of %d users took %.1fs, longer than the %ds between sweeps: at most %d probes run at a time"%(
+                total,self.last_sweep,DirectoryChecker.LOOP_WAIT,self.__max_probes))
+        if self.__delayed>0:
+            self.__logger.warning("%d probes waited for a file descriptor, consider a lower --max-probes"%self.__delayed)
+        return self.last_sweep
+
+    def __keepalive(self,sessions):
+        """
+        Drop the sessions that left too many PINGs unanswered,
+        and PING all the others
+        """
+        for username,session in sessions.items():
+            if session.pings_unanswered>=DirectoryChecker.KEEPALIVE_MISSED:
+                self.__failed+=1
+                self.__logger.error("USER %s ERROR (%d PINGs unanswered)"%(username,session.pings_unanswered))
+                if self.__directory.directory_detach(username,session):
+                    self.__directory.directory_deregister(username,callback=self.__saved)
+                session.drop("keepalive timeout")
+            else:
+                session.ping()
+        self.__logger.debug("%d users pinged in-band"%len(sessions))
+
+    def __saved(self,error):
+        """
+        The evictions are not acknowledged to anybody, so the checker
+        does not wait for the journal. Its failures are logged there.
+        """
+        pass
+
+    def __start_probes(self):
+        while self.__queue and self.__running<self.__max_probes:
+            username,address,port=self.__queue[0]
+            self.__logger.debug("sending ping to %s:%d"%(address,port))
+            try:
+                Probe(self.__loop,username,(address,port),DirectoryChecker.PROBE_DEADLINE,self.__probed)
+            except socket.error,e:
+                if self.__running>0:
+                    #out of file descriptors: retry once a probe releases its own
+                    self.__logger.debug("probe of %s delayed (%s), %d probes running"%(username,str(e),self.__running))
+                    self.__delayed+=1
+                    return
+                #nothing to wait for, the user is not to blame
+                self.__queue.popleft()
+                self.__failed+=1
+                self.__logger.error("USER %s ERROR (probe not started: %s)"%(username,str(e)))
+                continue
+            self.__queue.popleft()
+            self.__running+=1
+
+    def __probed(self,probe):
+        self.__running-=1
+
+        if probe.error==None:
+            self.__logger.info("USER %s OK"%probe.username)
+        else:
+            #client is misbehaving, deregister it unless it has
+            #bound somewhere else in the meantime
+            self.__failed+=1
+            self.__logger.error("USER %s ERROR (%s)"%(probe.username,probe.error))
+            res=self.__directory.directory_query(probe.username)
+            if len(res)==1 and res[0][1:]==probe.address:
+                self.__directory.directory_deregister(probe.username,callback=self.__saved)
+
+        self.__start_probes()
+        if self.__running==0:
+            self.__loop.stop()
                         
                     
         
+class Notifier(threading.Thread):
+    """
+    This thread fans the directory changes out to the subscribed
+    sessions. Writers only put the changes in a queue, and the
+    thread encodes every batch once for all the subscribers.
+    Subscriptions go through the same queue, so that a new
+    subscriber gets its first NOTIFY before any later change.
+    """
+    
+    def __init__(self,directory):
+        threading.Thread.__init__(self)
+        self.daemon=True
+
+        self.__directory=directory
+        self.__queue=Queue.Queue()
+        #subscribed sessions, mapped to the last version they know
+        self.__subscribers=dict()
+        self.__logger=logging.getLogger("notifier")
+
+    def publish(self,version,token,changes):
+        """
+        Queue the changes introducing a version, given as a list of
+        (username,entry or None). Never blocks.
+        """
+        self.__queue.put(("change",version,token,changes))
+
+    def subscribe(self,session,token=None):
+        self.__queue.put(("subscribe",session,token))
+
+    def unsubscribe(self,session):
+        self.__queue.put(("unsubscribe",session))
+
+    def run(self):
+        while True:
+            #take everything that is queued, and deliver it at once
+            batch=[self.__queue.get()]
+            try:
+                while True:
+                    batch.append(self.__queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            changes=[]
+            for item in batch:
+                if item[0]=="change":
+                    changes.append(item[1:])
+                    continue
+
+                self.__deliver(changes)
+                changes=[]
+                if item[0]=="subscribe":
+                    self.__start(item[1],item[2])
+                else:
+                    self.__subscribers.pop(item[1],None)
+            self.__deliver(changes)
+
+    def __start(self,session,token):
+        """
+        Send the first NOTIFY to a new subscriber: the changes since
+        its token, or the full listing
+        """
+        token,delta,payload=self.__directory.directory_sync(token)
+        session.notify([token,"delta" if delta else "full"],payload)
+        self.__subscribers[session]=int(token.split(".")[1])
+        self.__logger.debug("%d subscribers"%len(self.__subscribers))
+
+    def __deliver(self,changes):
+        """
+        Send a batch of (version,token,changes) to the subscribers.
+        Subscribers that already know some of the versions get a
+        payload of their own.
+        """
+        if not changes or not self.__subscribers:
+            return
+
+        first=changes[0][0]
+        last,token=changes[-1][0],changes[-1][1]
+        shared=None
+        for session,known in self.__subscribers.items():
+            if known>=last:
+                continue
+            elif known<first:
+                if shared==None:
+                    shared=self.__encode(changes)
+                payload=shared
+            else:
+                payload=self.__encode([c for c in changes if c[0]>known])
+            session.notify([token,"delta"],payload)
+            self.__subscribers[session]=last
+
+    def __encode(self,changes):
+        latest=dict()
+        for version,token,entries in changes:
+            latest.update(entries)
+        return encode_changes(latest)
+
+
 class Directory:
     """
     Directory information. All the methods 
     defined in this object are required to be thread
     safe, since the object will be shared among all
-    threads in concurrency
+    threads in concurrency.
+    Writers update the directory under a lock and give it a new
+    version number. Queries read an immutable snapshot of it, which
+    is copied once per version by the first query needing it, so
+    that a write never copies the directory and queries don't take
+    the lock, unless writers keep changing the directory while it is
+    being copied. The version number also keys
+    the cached payload of the full listing. The last
+    CHANGELOG_SIZE changes are logged with their version, so that
+    clients can fetch only what changed since the version they know.
+    Usernames are also kept sorted, so that prefix searches and
+    pages of the listing cost O(log n + page) instead of O(n).
+    If lease_ttl is not None, every registration is a lease
+    that expires lease_ttl seconds after the last BIND or RENEW.
+    Bound users receive a session token, signed with a secret, that
+    lets them register again with a single RESUME for session_ttl
+    seconds. A directory restarted with the same secret accepts the
+    tokens issued before the restart. A LEAVE revokes the tokens
+    issued so far to the user; the revocations are journaled, so they
+    survive a restart only along with a Journal.
+    If a Journal is given, the registrations are recovered from it at
+    startup, and every change is logged to it before being published.
+    The methods making a change return once it is durable, as the
+    journal policy requires, unless they are given a callback: they
+    return at once then, and the callback is called with None once
+    the change is durable, possibly from the journal thread. If the
+    journal can't be written any more, the change is still made but
+    they raise a JournalError, or pass it to the callback.
+    Recovered users get a new lease, if leases are granted.
     """
+    CHANGELOG_SIZE = 10000
+    SESSION_TTL = 3600
+    COPY_ATTEMPTS = 3
     
-    def __init__(self):
+    def __init__(self,lease_ttl=None,session_secret=None,session_ttl=SESSION_TTL,journal=None):
         """
         Define here all the synchronization objects
         """
+        self.lease_ttl=lease_ttl
+        self.session_ttl=session_ttl
+        self.__secret=session_secret or os.urandom(32)
+        #time, in milliseconds, at which users left with a LEAVE. The
+        #tokens issued before are not accepted any more. The revocations
+        #are also queued as (time,username) in the order they were made,
+        #to forget them once the tokens they refuse have expired
+        self.__left=dict()
+        self.__revocations=deque()
+        #current lease expiry of each user, and a min-heap of
+        #(expiry,username). Renewals push a new entry, and outdated
+        #entries are discarded when they reach the top of the heap
+        self.__expiry=dict()
+        self.__leases=[]
         #directory is a dictionary mapping usernames to
         #their address and ports
         self.__directory=dict()
+        #sorted list of the registered usernames
+        self.__names=[]
+        #increased before and after every change to the directory, so
+        #that queries copying it without the lock can tell a change
+        #happened meanwhile
+        self.__sequence=0
+        #(version,copy of the directory,sorted usernames). The copies are
+        #never modified, but replaced as a whole once the version they
+        #were made at is outdated. The directory copy maps usernames to
+        #the tuples (username,address,port) returned by the queries
+        self.__version=0
+        self.__snapshot=(0,dict(),())
+        #(version,payload) of the last full listing
+        self.__result=(0,"")
+        #log of (version,username,entry or None) for the last changes.
+        #It holds every change made after version __log_floor, and the
+        #epoch tells versions of different directory runs apart
+        self.__log=deque()
+        self.__log_floor=0
+        self.__epoch="%x"%int(time.time())
+        #started along with the first subscription
+        self.__notifier=None
+        #open sessions of the registered users, used for in-band keepalives
+        self.__sessions=dict()
         self.__directory_lock=threading.Lock()
+        #taken by the queries copying the directory, never by the writers
+        self.__copy_lock=threading.Lock()
         #our logger
         self.__logger=logging.getLogger("directory")
+
+        #persistence of the registrations, and the thread writing a snapshot
+        self.__journal=journal
+        self.__checkpoint=None
+        if journal!=None:
+            self.__recover()
+
+    def __recover(self):
+        """
+        Load the registrations saved in the journal
+        """
+        entries,names,revoked,payload=self.__journal.recover()
+        #as for the journal, none of the objects built can be part of a cycle
+        collecting=gc.isenabled()
+        gc.disable()
+        try:
+            self.__directory=entries
+            self.__names=names
+            self.__left=revoked
+            self.__revocations=deque(sorted([(left,username) for username,left in revoked.items()]))
+            self.__prune(int(time.time()*1000))
+            if self.lease_ttl!=None:
+                expiry=time.time()+self.lease_ttl
+                self.__expiry=dict.fromkeys(entries,expiry)
+                #sorted, hence already a heap
+                self.__leases=[(expiry,username) for username in self.__names]
+
+            self.__version=1
+        finally:
+            if collecting:
+                gc.enable()
+        if payload!=None:
+            #the snapshot is the listing, no need to encode it again
+            self.__result=(self.__version,payload)
     
     def directory_login(self,username,password):
         """
@@ -112,44 +581,611 @@ class Directory:
         """
         return True
     
-    def directory_register(self,username,address,port):
+    def directory_register(self,username,address,port,callback=None):
         """
-        Register a specific client in the directory service
+        Register a specific client in the directory service. A user
+        registered again at the same address is not a change: its
+        lease is renewed, but nothing is published or journaled.
         """
         self.__logger.info("REGISTER %s %s %d"%(username,address,port))
+        entry=(username,address,port)
+        ticket=None
+        self.__directory_lock.acquire()
+        if self.__directory.get(username)!=entry:
+            ticket=self.__publish([(username,entry)])
+        if self.lease_ttl!=None:
+            self.__grant(username)
+        self.__directory_lock.release()
+        self.__commit(ticket,callback)
+
+    def __publish(self,changes,revoked=()):
+        """
+        Apply a list of (username,entry) changes to the directory,
+        entry being None for the users that left, log them and start
+        a new version. Every change to the directory goes through
+        here, with the lock held. The session revocations made along
+        are journaled with the changes. Returns the journal ticket to
+        commit once the lock is released.
+        """
+        #odd while the directory and its index are being changed
+        self.__sequence+=1
+        for username,entry in changes:
+            if entry!=None:
+                self.__directory[username]=entry
+            else:
+                self.__directory.pop(username,None)
+
+            #keep the sorted index in line with the directory
+            i=bisect.bisect_left(self.__names,username)
+            indexed=i<len(self.__names) and self.__names[i]==username
+            if entry!=None and not indexed:
+                self.__names.insert(i,username)
+            elif entry==None and indexed:
+                del self.__names[i]
+        self.__version+=1
+        self.__sequence+=1
+
+        ticket=self.__journal.append(changes,revoked) if self.__journal!=None else None
+        for username,entry in changes:
+            self.__log.append((self.__version,username,entry))
+        while len(self.__log)>Directory.CHANGELOG_SIZE:
+            self.__log_floor=self.__log.popleft()[0]
+
+        if self.__notifier!=None:
+            self.__notifier.publish(self.__version,"%s.%d"%(self.__epoch,self.__version),changes)
+        return ticket
+
+    def __current(self):
+        """
+        Returns the snapshot of the current version, copying the
+        directory if no query did since the last change. The copy is
+        made without the directory lock, so that writers never wait
+        for it: dict() and tuple() are atomic under the GIL, and the
+        sequence number tells whether a change was made meanwhile,
+        in which case the copy is made again. One query copies at a
+        time, the others then find its copy. If writers keep changing
+        the directory through COPY_ATTEMPTS copies, the last one is
+        made under the lock.
+        """
+        snapshot=self.__snapshot
+        if snapshot[0]==self.__version:
+            return snapshot
+
+        self.__copy_lock.acquire()
+        try:
+            for attempt in xrange(Directory.COPY_ATTEMPTS):
+                sequence=self.__sequence
+                version=self.__version
+                if self.__snapshot[0]==version:
+                    return self.__snapshot
+                if sequence%2==0:
+                    directory=dict(self.__directory)
+                    names=tuple(self.__names)
+                    if self.__sequence==sequence:
+                        self.__snapshot=(version,directory,names)
+                        return self.__snapshot
+                #let the writer finish
+                time.sleep(0)
+
+            self.__directory_lock.acquire()
+            snapshot=self.__copy()
+            self.__directory_lock.release()
+            return snapshot
+        finally:
+            self.__copy_lock.release()
+
+    def __copy(self):
+        """
+        Same as __current, with the lock held
+        """
+        if self.__snapshot[0]!=self.__version:
+            self.__snapshot=(self.__version,dict(self.__directory),tuple(self.__names))
+        return self.__snapshot
+
+    def __commit(self,ticket,callback=None):
+        """
+        Wait until the changes are durable, as the journal policy
+        requires, or have the callback called then. Start a snapshot
+        once the journal grew enough.
+        """
+        if self.__journal==None:
+            if callback!=None:
+                callback(None)
+            return
+        self.__journal.commit(ticket,callback)
+
+        if self.__journal.needs_snapshot():
+            self.__directory_lock.acquire()
+            if self.__checkpoint==None or not self.__checkpoint.is_alive():
+                self.__checkpoint=threading.Thread(target=self.directory_checkpoint,name="checkpoint")
+                self.__checkpoint.daemon=True
+                self.__checkpoint.start()
+            self.__directory_lock.release()
+
+    def directory_checkpoint(self):
+        """
+        Write a snapshot of the directory to the journal, which then
+        starts over. Returns the number of entries written, or raises
+        the JournalError of a journal that can't be written.
+        """
+        self.__directory_lock.acquire()
+        try:
+            generation=self.__journal.rotate()
+            version,snapshot,names=self.__copy()
+            self.__prune(int(time.time()*1000))
+            revoked=dict(self.__left)
+        finally:
+            self.__directory_lock.release()
+
+        self.__journal.write_snapshot(generation,names,snapshot,revoked)
+        return len(names)
+
+    def directory_close(self):
+        """
+        Flush the journal, if any, before the directory goes away
+        """
+        if self.__journal!=None:
+            if self.__checkpoint!=None:
+                self.__checkpoint.join()
+            self.__journal.close()
+
+    def __grant(self,username):
+        """
+        Start a new lease for the user. Must be called with the lock held
+        """
+        expiry=time.time()+self.lease_ttl
+        self.__expiry[username]=expiry
+        heapq.heappush(self.__leases,(expiry,username))
+
+    def directory_renew(self,username):
+        """
+        Renew the lease of a registered user. Returns false if
+        the user is not registered (e.g. its lease has expired)
+        """
         self.__directory_lock.acquire()
-        self.__directory[username]=(address,port)
+        registered=username in self.__directory
+        if registered and self.lease_ttl!=None:
+            self.__grant(username)
         self.__directory_lock.release()
+        return registered
+
+    def directory_expire(self,now=None,callback=None):
+        """
+        Deregister all the users whose lease expired before now.
+        Returns the list of the expired usernames.
+        """
+        now=time.time() if now==None else now
+        expired=[]
+        self.__directory_lock.acquire()
+        while self.__leases and self.__leases[0][0]<=now:
+            expiry,username=heapq.heappop(self.__leases)
+            if self.__expiry.get(username)!=expiry:
+                #the lease was renewed or the user left
+                continue
+            self.__expiry.pop(username)
+            self.__sessions.pop(username,None)
+            expired.append(username)
+        ticket=self.__publish([(username,None) for username in expired]) if expired else None
+        self.__directory_lock.release()
+        self.__commit(ticket,callback)
+
+        for username in expired:
+            self.__logger.info("EXPIRE %s"%username)
+        return expired
         
-    def directory_deregister(self,username):
+    def directory_deregister(self,username,revoke=False,callback=None):
         """
-        Deregister a specific user from the directory service
+        Deregister a specific user from the directory service. On a
+        LEAVE, revoke is true: the session tokens issued so far to the
+        user are refused too.
         """
         self.__logger.info("DEREGISTER %s"%username)
         self.__directory_lock.acquire()
+        revoked=[]
+        if revoke:
+            left=int(time.time()*1000)
+            self.__left[username]=left
+            self.__revocations.append((left,username))
+            self.__prune(left)
+            revoked.append((username,left))
+        ticket=None
         if username in self.__directory:
-            self.__directory.pop(username)
+            ticket=self.__publish([(username,None)],revoked)
+        elif revoked and self.__journal!=None:
+            ticket=self.__journal.append([],revoked)
+        self.__sessions.pop(username,None)
+        self.__expiry.pop(username,None)
         self.__directory_lock.release()
+        self.__commit(ticket,callback)
+
+    def directory_session(self,username,address,port):
+        """
+        Returns a token that lets the user bound to address:port
+        register again with RESUME, skipping the login, the bind
+        and its port test
+        """
+        issued="%x"%int(time.time()*1000)
+        return "%s:%d:%s:%s"%(address,port,issued,self.__sign(username,address,port,issued))
+
+    def directory_binding(self,username,token):
+        """
+        Returns the tuple (address,port) the user was bound to when
+        the session token was issued, at which a RESUME registers it
+        again, or None if the token is forged, expired or older than
+        a LEAVE.
+        """
+        fields=token.split(":")
+        if len(fields)!=4 or not fields[1].isdigit():
+            return None
+        address,port,issued,mac=fields
+        if not hmac.compare_digest(mac,self.__sign(username,address,int(port),issued)):
+            return None
+
+        try:
+            issued_ms=int(issued,16)
+        except ValueError:
+            return None
+        if issued_ms+self.session_ttl*1000<time.time()*1000 or issued_ms<=self.__left.get(username,-1):
+            return None
+        return address,int(port)
+
+    def __prune(self,now):
+        """
+        Forget the revocations made more than session_ttl before now,
+        in milliseconds: the tokens they refuse have expired anyway.
+        Must be called with the lock held
+        """
+        horizon=now-self.session_ttl*1000
+        while self.__revocations and self.__revocations[0][0]<horizon:
+            left,username=self.__revocations.popleft()
+            if self.__left.get(username)==left:
+                del self.__left[username]
+
+    def __sign(self,username,address,port,issued):
+        return hmac.new(self.__secret,"%s %s %d %s"%(username,address,port,issued),hashlib.sha256).hexdigest()[:32]
+
+    def directory_attach(self,username,session):
+        """
+        Remember the open session through which a registered user
+        can be reached. A later session replaces an earlier one.
+        """
+        self.__directory_lock.acquire()
+        self.__sessions[username]=session
+        self.__directory_lock.release()
+
+    def directory_detach(self,username,session):
+        """
+        Forget the session of a user, unless it has been replaced
+        in the meantime. Returns true if the session was attached.
+        """
+        self.__directory_lock.acquire()
+        attached=self.__sessions.get(username) is session
+        if attached:
+            self.__sessions.pop(username)
+        self.__directory_lock.release()
+        return attached
+
+    def directory_sessions(self):
+        """
+        Returns a list of tuples (username,session) for all the
+        users that are reachable through an open session
+        """
+        self.__directory_lock.acquire()
+        res=self.__sessions.items()
+        self.__directory_lock.release()
+        return res
     
+    def directory_subscribe(self,session,token=None):
+        """
+        Push the changes to the directory to the session, through
+        its notify(args,payload) method, starting from the version
+        named by the token
+        """
+        self.__directory_lock.acquire()
+        if self.__notifier==None:
+            self.__notifier=Notifier(self)
+            self.__notifier.start()
+        self.__notifier.subscribe(session,token)
+        self.__directory_lock.release()
+
+    def directory_unsubscribe(self,session):
+        """
+        Stop pushing changes to the session
+        """
+        if self.__notifier!=None:
+            self.__notifier.unsubscribe(session)
+
     def directory_query(self,username=None):
         """
         Always returns a list of tuples (username,address,port).
         If username is not None, it will return a list containing
         only one tuple associated to the specific username.
         """
-        res=[]
-        self.__directory_lock.acquire()
-        if username!=None and username in self.__directory:
-            res.append((username,self.__directory[username][0],self.__directory[username][1]))
-        elif username==None:
-            res+=[(key,value[0],value[1]) for key,value in self.__directory.items()]
-        self.__directory_lock.release()
-        
-        return res
+        if username==None:
+            version,snapshot,names=self.__current()
+            return snapshot.values()
+
+        #a single lookup needs no snapshot, and is atomic under the GIL
+        entry=self.__directory.get(username)
+        return [entry] if entry!=None else []
+
+    def directory_page(self,prefix="",after=None,limit=100):
+        """
+        Returns a tuple (entries,cursor). Entries lists, in username
+        order, at most limit tuples (username,address,port) of the users
+        whose name starts with prefix and comes after the cursor given
+        in after. The returned cursor is None on the last page.
+        """
+        version,snapshot,names=self.__current()
+        start=bisect.bisect_left(names,prefix)
+        if after!=None:
+            start=max(start,bisect.bisect_right(names,after))
+
+        page=[]
+        end=start
+        while end<len(names) and len(page)<limit and names[end].startswith(prefix):
+            page.append(snapshot[names[end]])
+            end+=1
+
+        more=end<len(names) and names[end].startswith(prefix)
+        return page,(page[-1][0] if more and page else None)
+
+    def directory_version(self):
+        """
+        Version of the directory, increased by every change
+        """
+        return self.__version
+
+    def directory_result(self):
+        """
+        Returns the RESULT payload listing all the users. The payload
+        is encoded once per directory version and then reused.
+        """
+        return self.__full()[1]
+
+    def __full(self):
+        """
+        Returns the tuple (version,payload) of the full listing
+        """
+        version,snapshot,names=self.__current()
+        result=self.__result
+        if result[0]!=version:
+            result=(version,"\n".join(["%s,%s,%d"%i for i in snapshot.itervalues()]))
+            self.__result=result
+        return result
+
+    def directory_sync(self,token=None):
+        """
+        Returns a tuple (token,delta,payload). If the token names a
+        version still covered by the change log, delta is true and the
+        payload only lists what changed since then: "+username,address,port"
+        for users that joined or moved and "-username" for users that
+        left. Otherwise the payload is the full listing. The returned
+        token names the current version.
+        """
+        since=None
+        if token!=None and token.count(".")==1:
+            epoch,version=token.split(".")
+            if epoch==self.__epoch and version.isdigit():
+                since=int(version)
+
+        if since!=None:
+            changes=dict()
+            self.__directory_lock.acquire()
+            version=self.__version
+            covered=self.__log_floor<=since<=version
+            if covered:
+                #walk the log backwards, the first change seen for a user is its last one
+                for v,username,entry in reversed(self.__log):
+                    if v<=since:
+                        break
+                    if username not in changes:
+                        changes[username]=entry
+            self.__directory_lock.release()
+
+            if covered:
+                payload=encode_changes(changes)
+                return ("%s.%d"%(self.__epoch,version),True,payload)
+
+        version,payload=self.__full()
+        return ("%s.%d"%(self.__epoch,version),False,payload)
         
         
 
-class DirectoryClient(threading.Thread):
+class Session:
+    """
+    Directory protocol spoken over a client connection: the login,
+    or a RESUME, and then the authenticated commands. It is shared
+    by the threaded DirectoryClient and the event driven
+    AsyncDirectoryClient, which only differ in how they move bytes:
+    both hand the received messages, in order, to handle_message.
+    They implement send(type,args,payload), returning false once the
+    session is closed, close(failure), test_port(callback), which
+    calls callback with True or False once the bound port is tested,
+    and defer(callback), which returns the function the directory
+    calls once a change is durable, and which calls callback in
+    turn with the same arguments, or None to wait for the change in
+    the session.
+    """
+
+    def __init__(self,directory):
+        self.username=None
+        self.password=None
+        self.bind_address=None
+        self.bind_port=None
+        self.state=S_USER
+        #keepalive PINGs sent over this session and not answered yet
+        self.pings_unanswered=0
+        self.subscribed=False
+
+        self.__directory=directory
+        self.__logger=logging.getLogger("client")
+
+    def handle_message(self,msg):
+        """
+        Serve one message received from the client
+        """
+        if self.state==S_USER and msg.type==p.T_RESUME and len(msg.args)==2:
+            #restore the binding of a previous session in one round trip
+            bound=self.__directory.directory_binding(msg.args[0],msg.args[1]) if valid_username(msg.args[0]) else None
+            if bound==None:
+                return self.send(p.T_ERR,[],"session expired, authentication required")
+            self.__logger.info("RESUME %s"%msg.args[0])
+            self.username=msg.args[0]
+            self.bind_address,self.bind_port=bound
+            self.state=S_AUTHENTICATED
+            self.__register(self.__resumed)
+
+        elif self.state==S_USER:
+            #get the username
+            if msg.type!=p.T_USER or len(msg.args)!=1: return self.close("a 'USER <username>' command was expected!")
+            if not valid_username(msg.args[0]): return self.close("invalid username %s"%msg.args[0])
+            self.username=msg.args[0]
+            self.state=S_PASS
+            self.send(p.T_ACK,[],"hi %s, authentication required"%self.username)
+
+        elif self.state==S_PASS:
+            #get the password
+            if msg.type!=p.T_PASS or len(msg.args)!=1: return self.close("a 'PASS <password>' command was expected!")
+            self.password=msg.args[0]
+
+            if self.__directory.directory_login(self.username, self.password):
+                self.state=S_AUTHENTICATED
+                self.send(p.T_ACK,[],"successfully authenticated")
+            else:
+                return self.close("authentication failed")
+
+        #if we are here, we are successfully authenticated
+        #from now on, the client can send any sequence of queries, bind or leave commands
+        elif msg.type==p.T_BIND and len(msg.args)==2:
+            self.bind_address=msg.args[0]
+            self.bind_port=int(msg.args[1])
+            self.test_port(self.__port_tested)
+
+        elif msg.type==p.T_QUERY and len(msg.args)>0 and "=" in msg.args[0]:
+            #one page of the listing
+            try:
+                query=parse_page_query(msg.args)
+            except ValueError,e:
+                return self.send(p.T_ERR,[],"invalid page query: %s"%str(e))
+            entries,cursor=self.__directory.directory_page(*query)
+            payload="\n".join(["%s,%s,%d"%i for i in entries])
+            self.send(p.T_RESULT,["next=%s"%(cursor or "")],payload)
+
+        elif msg.type==p.T_QUERY and len(msg.args)<=1:
+            if len(msg.args)==1:
+                result=self.__directory.directory_query(msg.args[0])
+                payload="\n".join(["%s,%s,%d"%i for i in result])
+            else:
+                payload=self.__directory.directory_result()
+
+            self.send(p.T_RESULT,[],payload)
+
+        elif msg.type==p.T_SYNC and len(msg.args)<=1:
+            token,delta,payload=self.__directory.directory_sync(msg.args[0] if len(msg.args)==1 else None)
+            self.send(p.T_RESULT,[token,"delta" if delta else "full"],payload)
+
+        elif msg.type==p.T_SUBSCRIBE and len(msg.args)<=1:
+            if not self.send(p.T_ACK,[],"subscribed to directory changes"): return
+            self.subscribed=True
+            self.__directory.directory_subscribe(self, msg.args[0] if len(msg.args)==1 else None)
+
+        elif msg.type==p.T_RENEW and len(msg.args)==0 and self.bind_port!=None:
+            if self.__directory.directory_renew(self.username):
+                self.__renewed()
+            else:
+                #the lease expired, but the session proves the client is alive
+                self.__register(self.__renewed)
+
+        elif msg.type==p.T_LEAVE and len(msg.args)==0:
+            self.bind_address=self.bind_port=None
+            self.__durably(self.__deregistered,self.__directory.directory_deregister,self.username,True)
+
+        elif msg.type==p.T_PONG:
+            #answer to a keepalive PING
+            self.pings_unanswered=0
+
+        elif msg.type==p.T_PING:
+            #clients may keep an idle session open with PINGs
+            self.send(p.T_PONG)
+
+        else:
+            return self.close("I did not understand the message %s"%msg.type)
+
+    def __port_tested(self,success):
+        """
+        Completion of the port test started by a BIND
+        """
+        if not success:
+            self.__logger.error("port test failed %s"%self.username)
+            return self.close("invalid bind notification")
+
+        self.__logger.debug("port test successful %s"%self.username)
+        self.__register(self.__bound)
+
+    def __register(self,callback):
+        """
+        Register the binding of the session, then call callback once
+        the registration is durable and the session attached to it
+        """
+        def registered():
+            self.__directory.directory_attach(self.username, self)
+            callback()
+        self.__durably(registered,self.__directory.directory_register,self.username,self.bind_address,self.bind_port)
+
+    def __durably(self,then,change,*args):
+        """
+        Apply a change to the directory and call then once it is
+        durable. The session is closed instead if the journal fails.
+        """
+        def done(error=None):
+            if error!=None:
+                return self.close("directory journal failure: %s"%error)
+            then()
+        callback=self.defer(done)
+        try:
+            change(*(args+(callback,)))
+        except JournalError,e:
+            return done(e)
+        if callback==None:
+            done()
+
+    def __bound(self):
+        self.send(p.T_ACK,self.__binding(),"bound successfully to %s:%d"%(self.bind_address,self.bind_port))
+
+    def __resumed(self):
+        self.send(p.T_ACK,self.__binding(),"resumed, bound to %s:%d"%(self.bind_address,self.bind_port))
+
+    def __renewed(self):
+        self.send(p.T_ACK,self.__lease(),"lease renewed")
+
+    def __deregistered(self):
+        self.send(p.T_ACK,[],"deregistered from directory")
+
+    def __lease(self):
+        """
+        ACK arguments for BIND and RENEW: the lease duration, if any
+        """
+        return [] if self.__directory.lease_ttl==None else [self.__directory.lease_ttl]
+
+    def __binding(self):
+        """
+        ACK arguments for BIND and RESUME: the lease duration, if
+        any, and the token to resume the session with
+        """
+        return self.__lease()+["session=%s"%self.__directory.directory_session(self.username,self.bind_address,self.bind_port)]
+
+    def detach(self):
+        """
+        Forget the session once its connection is closed
+        """
+        self.state=S_CLOSED
+        self.__directory.directory_detach(self.username, self)
+        if self.subscribed:
+            self.__directory.directory_unsubscribe(self)
+
+
+class DirectoryClient(threading.Thread,Session):
     """
     Separate thread in charge of the communication
     with each client.
@@ -162,14 +1198,11 @@ class DirectoryClient(threading.Thread):
         3) the address info tuple
         """
         threading.Thread.__init__(self)
+        Session.__init__(self,directory)
         
-        self.username=None
-        self.password=None
-        self.bind_address=None
-        self.bind_port=None
-        
-        self.__directory=directory
         self.__protocol=ProtocolWrapper(clisock,addrinfo)
+        #counters of the outgoing traffic
+        self.stats=self.__protocol.stats
         
         #we are not interested in joining these threads
         self.daemon=True
@@ -178,84 +1211,404 @@ class DirectoryClient(threading.Thread):
         
         
         
-    def __port_test(self):
+    def test_port(self,callback):
         """
         Simple check to ensure the reachability of a client before
-        registering it to the directory service.
+        registering it to the directory service. The session thread
+        waits for the connection attempt.
         """
         try:
             s=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
             s.connect((self.bind_address,self.bind_port))
             s.close()
-            self.__logger.debug("port test successful %s"%self.username)
-            return True
+            success=True
         except socket.error:
-            self.__logger.error("port test failed %s"%self.username)
+            success=False
+        callback(success)
+
+    def defer(self,callback):
+        """
+        The session thread waits for the changes to be durable
+        """
+        return None
+
+    def send(self,message_type,message_args=[],message_payload=""):
+        """
+        Send a message, closing the session if it can't be sent.
+        Returns false if the session is closed.
+        """
+        if self.state==S_CLOSED:
             return False
+        if not self.__protocol.send(message_type,message_args,message_payload):
+            self.close()
+            return False
+        return True
+
+    def close(self,failure=None):
+        """
+        Close the session. If a failure string is provided, send
+        back an ERR message first.
+        """
+        if self.state==S_CLOSED:
+            return
+        self.state=S_CLOSED
+        self.__protocol.close(failure)
+
+    def ping(self):
+        """
+        Send a keepalive PING over the session. Called by the checker
+        thread, the PONG is collected by the session thread. The
+        checker must not wait for the client: the session is shut
+        down if the PING can't be written at once.
+        """
+        self.pings_unanswered+=1
+        if self.__protocol.send_nowait(p.T_PING)==False:
+            self.__logger.error("PING not sent, %s does not read: shutting down"%self.username)
+            self.__protocol.shutdown()
+
+    def drop(self,failure):
+        """
+        Close the session from another thread, without waiting
+        for the client: the session thread then closes it.
+        """
+        self.__protocol.send_nowait(p.T_ERR,[],failure)
+        self.__protocol.shutdown()
+
+    def notify(self,args,payload):
+        """
+        Push directory changes to the client. Called by the notifier
+        thread: a slow client delays the other subscribers, but never
+        the directory writers.
+        """
+        self.__protocol.send(p.T_NOTIFY,args,payload)
         
     def run(self):
         """
         The thread executes here.
         """
-        #user authentication
         try:
-            #get the username
-            msg=self.__protocol.recv(True)
-            if msg==None or msg.type!=p.T_USER or len(msg.args)!=1: return self.__protocol.close("a 'USER <username>' command was expected!")
-            self.username=msg.args[0]
-            if not self.__protocol.send(p.T_ACK,[],"hi %s, authentication required"%self.username): return self.__protocol.close()
-
-            #get the password
-            msg=self.__protocol.recv(True)
-            if msg==None or msg.type!=p.T_PASS or len(msg.args)!=1: return self.__protocol.close("a 'PASS <password>' command was expected!")
-            self.password=msg.args[0]
-            
-            if self.__directory.directory_login(self.username, self.password):
-                if not self.__protocol.send(p.T_ACK,[],"successfully authenticated"): return self.__protocol.close()
-            else:
-                return self.__protocol.close("authentication failed")
-            
-            #if we are here, we are successfully authenticated
-            #from now on, the client can send any sequence of queries, bind or leave commands
-            while True:
+            while self.state!=S_CLOSED:
                 msg=self.__protocol.recv()
-                if msg==None:   return self.__protocol.close() #connection was closed by client
-                
-                if msg.type==p.T_BIND and len(msg.args)==2:
-                    self.bind_address=msg.args[0]
-                    self.bind_port=int(msg.args[1])
-                    
-                    if self.__port_test():
-                        self.__directory.directory_register(self.username, self.bind_address, self.bind_port)
-                        if not self.__protocol.send(p.T_ACK,[],"bound successfully to %s:%d"%(self.bind_address,self.bind_port)): return self.__protocol.close()
-                    else:
-                        return self.__protocol.close("invalid bind notification")
-                        
-                elif msg.type==p.T_QUERY and len(msg.args)<=1:
-                    username=msg.args[0] if len(msg.args)==1 else None
-                    result=self.__directory.directory_query(username)
-                    payload="\n".join(["%s,%s,%d"%i for i in result])
-                    
-                    if not self.__protocol.send(p.T_RESULT,[],payload): self.__protocol.close()
-                elif msg.type==p.T_LEAVE and len(msg.args)==0:
-                    self.__directory.directory_deregister(self.username)
-                    if not self.__protocol.send(p.T_ACK,[],"deregistered from directory"): return self.__protocol.close()
-                else:
-                    return self.__protocol.close("I did not understand the message %s"%msg.type)
+                if msg==None:   return self.close() #connection was closed by client
+                self.handle_message(msg)
                     
         except socket.timeout:
-            self.__protocol.close("shutting down idle connection (timeout)")
+            self.close("shutting down idle connection (timeout)")
+        except p.ParseError,e:
+            self.close(str(e))
         except:
-            self.__protocol.close("unexpected error")
+            self.close("unexpected error")
             self.__logger.exception("something unexpected went wrong!")
+        finally:
+            self.detach()
+
+
+class PortTest:
+    """
+    Non blocking version of DirectoryClient.__port_test. A connection
+    attempt towards the bound port is started, and the callback is
+    invoked with True or False once it completes or times out.
+    """
+    TIMEOUT = 10
+
+    def __init__(self,loop,address,callback):
+        self.__loop=loop
+        self.__callback=callback
+        self.__timer=None
+        self.__sock=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self.__sock.setblocking(0)
+        self.__fd=self.__sock.fileno()
+
+        try:
+            err=self.__sock.connect_ex(address)
+        except socket.error:
+            err=errno.EINVAL
+
+        if err in (0,errno.EINPROGRESS,errno.EWOULDBLOCK):
+            self.__loop.register(self,EV_WRITE)
+            self.__timer=self.__loop.call_later(PortTest.TIMEOUT,self.__done,False)
+        else:
+            #report the failure from the loop, never from the constructor
+            self.__loop.call_later(0,self.__done,False)
+
+    def fileno(self):
+        return self.__fd
+
+    def handle_read(self):
+        pass
+
+    def handle_write(self):
+        #the connection attempt completed, check how it went
+        err=self.__sock.getsockopt(socket.SOL_SOCKET,socket.SO_ERROR)
+        self.__done(err==0)
+
+    def handle_close(self):
+        self.__done(False)
+
+    def __done(self,success):
+        if self.__callback==None:
+            return
+        if self.__timer!=None:
+            self.__timer.cancel()
+        self.__loop.unregister(self)
+        self.__sock.close()
+
+        callback,self.__callback=self.__callback,None
+        callback(success)
+
+
+class AsyncDirectoryClient(Session):
+    """
+    Event driven counterpart of DirectoryClient. It serves the same
+    Session, but instead of owning a thread blocked in recv it is
+    driven by the EventLoop, so an idle session costs a socket and
+    a handful of attributes.
+    """
+    IDLE_TIMEOUT = 30
+    #as in ProtocolWrapper: Nagle's algorithm off, and the answers
+    #held back during a batch are written once they exceed FLUSH_SIZE
+    NODELAY = True
+    FLUSH_SIZE = 65536
+
+    def __init__(self,loop,directory,clisock,addrinfo):
+        """
+        The client takes as input four arguments:
+        1) the event loop serving the connection
+        2) the instance of the directory object
+        3) the connected socket associated with the client
+        4) the address info tuple
+        """
+        Session.__init__(self,directory)
+
+        self.__loop=loop
+        self.__sock=clisock
+        self.__sock.setblocking(0)
+        self.__sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,AsyncDirectoryClient.NODELAY)
+        self.__fd=clisock.fileno()
+
+        #decoder of the received stream, and messages not served yet
+        self.__decoder=p.StreamDecoder()
+        self.__pending=deque()
+        #buffers waiting for the socket to become writable, and the
+        #number of bytes queued since the last flush
+        self.__outbuf=deque()
+        self.__held=0
+        #counters of the outgoing traffic
+        self.stats=TransportStats()
+        self.__writing=False
+        #set while a port test runs, or a change is made durable: the
+        #following messages must wait
+        self.__waiting=False
+        #set while serving a batch of messages, whose answers are
+        #written all together at the end
+        self.__serving=False
+        #close the socket as soon as the output buffer is empty
+        self.__closing=False
+
+        self.__logger=logging.getLogger("client")
+        self.__logger.debug("new connection from %s:%d"%addrinfo)
+
+        self.__last_activity=time.time()
+        self.__idle_timer=loop.call_later(AsyncDirectoryClient.IDLE_TIMEOUT,self.__check_idle)
+        loop.register(self,EV_READ)
+
+    def fileno(self):
+        return self.__fd
+
+    def handle_read(self):
+        try:
+            data=self.__sock.recv(4096)
+        except socket.error,e:
+            if e.args[0] in (errno.EAGAIN,errno.EWOULDBLOCK):
+                return
+            self.__logger.error("receive error: %s"%str(e))
+            return self.__shutdown()
+
+        if not data:
+            #connection was closed by client
+            return self.__shutdown()
+
+        self.__last_activity=time.time()
+        try:
+            self.__pending.extend(self.__decoder.feed(data))
+        except p.ParseError,e:
+            return self.close(str(e))
+        self.__serve()
+
+    def handle_write(self):
+        self.__flush()
+
+    def handle_close(self):
+        self.__shutdown()
+
+    def __serve(self):
+        """
+        Serve the received messages in order, unless a port test
+        is still pending. The answers to pipelined requests are
+        written with a single send.
+        """
+        self.__serving=True
+        while self.__pending and not self.__waiting and self.state!=S_CLOSED:
+            try:
+                self.handle_message(self.__pending.popleft())
+            except:
+                self.close("unexpected error")
+                self.__logger.exception("something unexpected went wrong!")
+        if self.__waiting:
+            #the answers are held until the port test completes
+            return
+        self.__serving=False
+        self.__flush()
+
+    def test_port(self,callback):
+        """
+        Start a non blocking port test. The messages received in the
+        meantime wait, and their answers are held, until it completes.
+        """
+        self.__waiting=True
+        PortTest(self.__loop,(self.bind_address,self.bind_port),lambda success: self.__continue(callback,success))
+
+    def defer(self,callback):
+        """
+        The following messages wait, and their answers are held, until
+        the change is durable. The directory may call the function
+        returned from the journal thread, so it hands callback over
+        to the loop.
+        """
+        self.__waiting=True
+        return lambda *args: self.__loop.call_from_thread(self.__continue,callback,*args)
+
+    def __continue(self,callback,*args):
+        """
+        Complete the operation the session was waiting for, then
+        serve the messages received in the meantime
+        """
+        self.__waiting=False
+        if self.state==S_CLOSED:
+            self.__serving=False
+            return self.__flush()
+
+        callback(*args)
+        self.__serve()
+
+    def ping(self):
+        """
+        Send a keepalive PING over the session. Called by the
+        checker thread, so the write is handed over to the loop.
+        """
+        self.pings_unanswered+=1
+        self.__loop.call_from_thread(self.send,p.T_PING)
+
+    def drop(self,failure):
+        """
+        Close the session from another thread
+        """
+        self.__loop.call_from_thread(self.close,failure)
+
+    def notify(self,args,payload):
+        """
+        Push directory changes to the client. Called by the notifier
+        thread, so the write is handed over to the loop.
+        """
+        self.__loop.call_from_thread(self.send,p.T_NOTIFY,args,payload)
+
+    def __check_idle(self):
+        """
+        The idle timer is not rescheduled on every message. When it
+        fires, it checks the last activity and rearms itself if needed.
+        """
+        idle=time.time()-self.__last_activity
+        if idle>=AsyncDirectoryClient.IDLE_TIMEOUT:
+            self.close("shutting down idle connection (timeout)")
+        else:
+            self.__idle_timer=self.__loop.call_later(AsyncDirectoryClient.IDLE_TIMEOUT-idle,self.__check_idle)
+
+    def send(self,message_type,message_args=[],message_payload=""):
+        """
+        Queue a message and try to write it right away, or at the end
+        of the batch being served. Returns false if the session is
+        already closed.
+        """
+        if self.state==S_CLOSED:
+            return False
+
+        for b in p.Message(message_type,message_args,message_payload).encode():
+            self.__outbuf.append(b)
+            self.__held+=len(b)
+        self.stats.messages+=1
+        if not self.__serving or self.__held>=AsyncDirectoryClient.FLUSH_SIZE:
+            self.__flush()
+        return True
+
+    def __flush(self):
+        if self.__sock==None:
+            return
+
+        self.__held=0
+        if len(self.__outbuf)>1:
+            self.__outbuf=deque(p.gather(self.__outbuf))
+        while self.__outbuf:
+            chunk=self.__outbuf[0]
+            try:
+                self.stats.syscalls+=1
+                sent=self.__sock.send(chunk)
+            except socket.error,e:
+                if e.args[0] not in (errno.EAGAIN,errno.EWOULDBLOCK):
+                    self.__logger.error("send error: %s"%str(e))
+                    return self.__shutdown()
+                break
+            self.stats.bytes+=sent
+            if sent<len(chunk):
+                #keep the rest for later, without copying it
+                self.__outbuf[0]=buffer(chunk,sent)
+                break
+            self.__outbuf.popleft()
+
+        if self.__outbuf and not self.__writing:
+            self.__writing=True
+            self.__loop.modify(self,EV_READ|EV_WRITE)
+        elif not self.__outbuf:
+            if self.__closing:
+                return self.__shutdown()
+            if self.__writing:
+                self.__writing=False
+                self.__loop.modify(self,EV_READ)
+
+    def close(self,failure=None):
+        """
+        Close the session once the pending output is written. If a
+        failure string is provided, send back an ERR message first.
+        """
+        if failure!=None:
+            self.__logger.debug("failure: %s"%failure)
+            self.send(p.T_ERR,[],failure)
+
+        self.state=S_CLOSED
+        self.__closing=True
+        if not self.__serving:
+            self.__flush()
+
+    def __shutdown(self):
+        if self.__sock==None:
+            return
+        self.__logger.debug("closing connection (%s)"%self.stats)
+        totals.add(self.stats)
+        self.detach()
+        self.__idle_timer.cancel()
+        self.__loop.unregister(self)
+        self.__sock.close()
+        self.__sock=None
 
 class Server:
     """
     Main directory server class. Keeps track of connected clients
     and 
     """
+    #seconds to wait before accepting again after a failed accept,
+    #e.g. when out of file descriptors
+    ACCEPT_PAUSE = 1
     
-    def __init__(self,address="127.0.0.1",port=8888):
+    def __init__(self,address="127.0.0.1",port=8888,inband=False,lease_ttl=None,session_secret=None,journal=None,max_probes=DirectoryChecker.MAX_PROBES):
         """
         Upon construction, let's bind the socket that
         will be used for the interaction with the clients
@@ -266,9 +1619,9 @@ class Server:
         self.__sock.listen(15)
         
         #the directory service, shared among all threads
-        self.__directory=Directory()
+        self.__directory=Directory(lease_ttl,session_secret,journal=journal)
         #the directory checker, that ensures everything is behaving well
-        self.__checker=DirectoryChecker(self.__directory)
+        self.__checker=DirectoryChecker(self.__directory,inband,max_probes)
         
         #logger
         self.__logger=logging.getLogger("server")
@@ -286,13 +1639,95 @@ class Server:
             try:
                 clisock,addr=self.__sock.accept()
             except KeyboardInterrupt,e:
-                return 
+                break
+            except socket.error,e:
+                #the connection stays in the backlog, retrying at once would fail again
+                self.__logger.error("accept error: %s"%str(e))
+                time.sleep(Server.ACCEPT_PAUSE)
+                clisock=addr=None
             except:
                 clisock=addr=None
             
             if clisock!=None:
                 d=DirectoryClient(self.__directory,clisock,addr)
                 d.start()
+        self.__directory.directory_close()
+        self.__logger.info("outgoing traffic: %s"%totals)
+
+
+class EventServer:
+    """
+    Directory server driven by a single event loop. It shares the
+    Directory and the DirectoryChecker with the threaded Server, but
+    serves every client from the main thread.
+    When accept fails, e.g. because the process is out of file
+    descriptors, the listening socket is left out of the loop for
+    ACCEPT_PAUSE seconds: the pending connection keeps it readable,
+    and polling it meanwhile would only spin.
+    """
+    ACCEPT_PAUSE = 1
+
+    def __init__(self,address="127.0.0.1",port=8888,inband=False,lease_ttl=None,session_secret=None,journal=None,max_probes=DirectoryChecker.MAX_PROBES):
+        """
+        Bind the listening socket and register it to the event loop
+        """
+        self.__sock=socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+        self.__sock.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,True)
+        self.__sock.bind((address,port))
+        self.__sock.listen(socket.SOMAXCONN)
+        self.__sock.setblocking(0)
+
+        #the directory service and its checker, as in the threaded server
+        self.__directory=Directory(lease_ttl,session_secret,journal=journal)
+        self.__checker=DirectoryChecker(self.__directory,inband,max_probes)
+
+        self.__loop=EventLoop()
+        self.__loop.register(self,EV_READ)
+
+        #logger
+        self.__logger=logging.getLogger("server")
+        self.__logger.info("waiting for connections on %s:%d (event loop)"%(address,port))
+
+    def fileno(self):
+        return self.__sock.fileno()
+
+    def handle_read(self):
+        """
+        Accept every pending connection
+        """
+        while True:
+            try:
+                clisock,addr=self.__sock.accept()
+            except socket.error,e:
+                if e.args[0] in (errno.EAGAIN,errno.EWOULDBLOCK):
+                    return
+                if e.args[0] in (errno.ECONNABORTED,errno.EINTR):
+                    #the client gave up before being accepted
+                    continue
+                self.__logger.error("accept error: %s, pausing for %ds"%(str(e),EventServer.ACCEPT_PAUSE))
+                self.__loop.unregister(self)
+                self.__loop.call_later(EventServer.ACCEPT_PAUSE,self.__loop.register,self,EV_READ)
+                return
+
+            AsyncDirectoryClient(self.__loop,self.__directory,clisock,addr)
+
+    def handle_write(self):
+        pass
+
+    def handle_close(self):
+        self.__logger.error("listening socket failed")
+
+    def main_loop(self):
+        """
+        Start the checker and serve all the clients from this thread
+        """
+        self.__checker.start()
+        try:
+            self.__loop.run()
+        except KeyboardInterrupt,e:
+            pass
+        self.__directory.directory_close()
+        self.__logger.info("outgoing traffic: %s"%totals)
 
 
 
@@ -300,12 +1735,19 @@ if __name__=="__main__":
     os.system('clear')
 
     from optparse import OptionParser
-    from cliutils import daemonize,setup_logging
+    from cliutils import daemonize,setup_logging,raise_fd_limit,load_secret
     
     op=OptionParser()
     op.add_option("-v","--verbose",dest="verbose",action="store_true",help="Enable debug output")
     op.add_option("-D","--daemon",dest="daemon",action="store_true",help="Daemonize process")
     op.add_option("-l","--logfile",dest="logfile",type="str",help="Store logs to a file instead of standard output")
+    op.add_option("-k","--keepalive",dest="keepalive",action="store_true",help="Check liveness with PINGs over the open directory sessions")
+    op.add_option("-t","--lease-ttl",dest="lease_ttl",type="int",help="Register users with leases of LEASE_TTL seconds, renewed by the clients")
+    op.add_option("-e","--event-loop",dest="eventloop",action="store_true",help="Serve all clients from a single event loop instead of one thread per client")
+    op.add_option("-s","--secret-file",dest="secret_file",type="str",help="Sign the session tokens with the secret kept in this file, so that they remain valid after a restart")
+    op.add_option("-j","--journal",dest="journal",type="str",help="Keep the registrations in this folder, to recover them after a restart")
+    op.add_option("-p","--max-probes",dest="max_probes",type="int",help="Number of users probed at the same time, by default half of the file descriptors the process can open")
+    op.add_option("-f","--fsync",dest="fsync",type="choice",choices=list(SYNC_POLICIES),default=SYNC_GROUP,help="When journal writes are fsynced: always, group (shared by concurrent writes, default) or periodic")
     
     (values,args)=op.parse_args()
     
@@ -314,7 +1756,14 @@ if __name__=="__main__":
         #daemonize()
     
     setup_logging(verbose=values.verbose, logfile=values.logfile)
+    secret=load_secret(values.secret_file) if values.secret_file!=None else None
+    journal=Journal(values.journal,values.fsync) if values.journal!=None else None
+    #every session and every probe holds a file descriptor, allow as many as we can
+    max_probes=values.max_probes or DirectoryChecker.probe_limit(raise_fd_limit())
     
-    s=Server()
+    if values.eventloop==True:
+        s=EventServer(inband=values.keepalive==True,lease_ttl=values.lease_ttl,session_secret=secret,journal=journal,max_probes=max_probes)
+    else:
+        s=Server(inband=values.keepalive==True,lease_ttl=values.lease_ttl,session_secret=secret,journal=journal,max_probes=max_probes)
     s.main_loop()
     
@@ -0,0 +1,220 @@
+'''
+ _   _      _          _____
+| \ | |    | |        |_   _|
+|  \| | ___| |___      _| |
+| . ` |/ _ \ __\ \ /\ / / |
+| |\  |  __/ |_ \ V  V /| |_
+|_| \_|\___|\__| \_/\_/_____|
+
+Introduction to computer networking and Internet
+================================================
+Single threaded event loop
+'''
+import select
+import heapq
+import errno
+import fcntl
+import time
+import os
+import logging
+
+from collections import deque
+
+#readiness flags. epoll and poll share the same values
+EV_READ=select.POLLIN
+EV_WRITE=select.POLLOUT
+EV_ERROR=select.POLLERR|select.POLLHUP
+
+
+class Timer:
+    """
+    Handle returned by EventLoop.call_later. Cancelled timers
+    are simply skipped when they reach the top of the heap.
+    """
+
+    def __init__(self,when,function,args):
+        self.when=when
+        self.function=function
+        self.args=args
+        self.cancelled=False
+
+    def cancel(self):
+        self.cancelled=True
+
+
+class Waker:
+    """
+    Self pipe used by other threads to interrupt a blocking poll
+    """
+
+    def __init__(self):
+        self.__rfd,self.__wfd=os.pipe()
+        for fd in (self.__rfd,self.__wfd):
+            fcntl.fcntl(fd,fcntl.F_SETFL,fcntl.fcntl(fd,fcntl.F_GETFL)|os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.__rfd
+
+    def wake(self):
+        try:
+            os.write(self.__wfd,"x")
+        except OSError:
+            #the pipe is full, the loop is going to wake up anyway
+            pass
+
+    def handle_read(self):
+        try:
+            os.read(self.__rfd,4096)
+        except OSError:
+            pass
+
+    def handle_write(self):
+        pass
+
+    def handle_close(self):
+        pass
+
+
+class EventLoop:
+    """
+    Readiness based event loop. It uses epoll when available and
+    falls back to poll otherwise, so the cost of one iteration
+    depends on the number of active sockets and not on the number
+    of registered ones.
+    Handlers are objects exposing fileno(), handle_read(),
+    handle_write() and handle_close(). Timers are kept in a heap
+    ordered by expiry time.
+    """
+
+    def __init__(self):
+        if hasattr(select,"epoll"):
+            self.__poller=select.epoll()
+            self.__scale=1.0
+        else:
+            self.__poller=select.poll()
+            self.__scale=1000.0
+
+        #map file descriptors to their handlers
+        self.__handlers=dict()
+        #heap of (expiry time, sequence number, timer)
+        self.__timers=[]
+        self.__sequence=0
+        self.__running=False
+        #calls posted by other threads, and the pipe used to notify them
+        self.__calls=deque()
+        self.__waker=Waker()
+
+        self.__logger=logging.getLogger("eventloop")
+        self.register(self.__waker,EV_READ)
+
+    def register(self,handler,events=EV_READ):
+        """
+        Start monitoring the handler for the given events
+        """
+        fd=handler.fileno()
+        self.__handlers[fd]=handler
+        self.__poller.register(fd,events)
+
+    def modify(self,handler,events):
+        """
+        Change the set of events monitored for the handler
+        """
+        self.__poller.modify(handler.fileno(),events)
+
+    def unregister(self,handler):
+        """
+        Stop monitoring the handler. Must be called before
+        the underlying socket is closed.
+        """
+        fd=handler.fileno()
+        if self.__handlers.pop(fd,None)!=None:
+            self.__poller.unregister(fd)
+
+    def call_later(self,delay,function,*args):
+        """
+        Schedule function(*args) to run after delay seconds.
+        Returns a Timer that can be cancelled.
+        """
+        t=Timer(time.time()+delay,function,args)
+        self.__sequence+=1
+        heapq.heappush(self.__timers,(t.when,self.__sequence,t))
+        return t
+
+    def call_from_thread(self,function,*args):
+        """
+        Schedule function(*args) to run in the loop thread as soon
+        as possible. This is the only method that can be safely
+        called from other threads.
+        """
+        self.__calls.append((function,args))
+        self.__waker.wake()
+
+    def stop(self):
+        self.__running=False
+
+    def __next_timeout(self):
+        """
+        How long poll can block before the next timer is due
+        """
+        while self.__timers and self.__timers[0][2].cancelled:
+            heapq.heappop(self.__timers)
+        if not self.__timers:
+            return -1
+        return max(0,self.__timers[0][0]-time.time())
+
+    def __run_timers(self):
+        now=time.time()
+        while self.__timers and self.__timers[0][0]<=now:
+            t=heapq.heappop(self.__timers)[2]
+            if t.cancelled:
+                continue
+            try:
+                t.function(*t.args)
+            except Exception:
+                self.__logger.exception("timer callback failed")
+
+    def __run_calls(self):
+        while self.__calls:
+            function,args=self.__calls.popleft()
+            try:
+                function(*args)
+            except Exception:
+                self.__logger.exception("posted call failed")
+
+    def __dispatch(self,fd,events):
+        handler=self.__handlers.get(fd)
+        if handler==None:
+            return
+        try:
+            if events&EV_READ:
+                handler.handle_read()
+            if events&EV_WRITE and fd in self.__handlers:
+                handler.handle_write()
+            if events&EV_ERROR and not events&EV_READ and fd in self.__handlers:
+                handler.handle_close()
+        except Exception:
+            self.__logger.exception("handler for fd %d failed"%fd)
+            if fd in self.__handlers:
+                handler.handle_close()
+
+    def run(self):
+        """
+        Loop until stop() is called
+        """
+        self.__running=True
+        while self.__running:
+            timeout=self.__next_timeout()
+            if timeout>=0:
+                timeout*=self.__scale
+            try:
+                events=self.__poller.poll(timeout)
+            except (IOError,select.error),e:
+                if e.args[0]==errno.EINTR:
+                    continue
+                raise
+
+            for fd,ev in events:
+                self.__dispatch(fd,ev)
+
+            self.__run_calls()
+            self.__run_timers()
@@ -0,0 +1,489 @@
+'''
+ _   _      _          _____
+| \ | |    | |        |_   _|
+|  \| | ___| |___      _| |
+| . ` |/ _ \ __\ \ /\ / / |
+| |\  |  __/ |_ \ V  V /| |_
+|_| \_|\___|\__| \_/\_/_____|
+
+Introduction to computer networking and Internet
+================================================
+Persistence of the directory: journal and snapshots
+'''
+import threading
+import logging
+import bisect
+import mmap
+import time
+import gc
+import os
+
+#fsync policies. With SYNC_ALWAYS every change is fsynced on its own
+#before being acknowledged. With SYNC_GROUP changes are acknowledged
+#once fsynced too, but all the changes made while a fsync runs share
+#the next one. Either way the fsyncs are made by the flusher thread,
+#never by the writers. With SYNC_PERIODIC changes are acknowledged at once and
+#fsynced every SYNC_INTERVAL seconds, so a crash loses the last ones
+SYNC_ALWAYS="always"
+SYNC_GROUP="group"
+SYNC_PERIODIC="periodic"
+SYNC_POLICIES=(SYNC_ALWAYS,SYNC_GROUP,SYNC_PERIODIC)
+
+
+class JournalError(Exception):
+    pass
+
+
+class Journal:
+    """
+    Keeps the directory entries in a folder, as a compacted snapshot
+    and the journals of the changes made since. The snapshot lists
+    the entries sorted by username, one "username,address,port" per
+    line as in a RESULT payload, after a header naming the first
+    journal generation it does not include and the session
+    revocations, one "!username,milliseconds" line each. Journals
+    are append-only files of "+username,address,port" and "-username"
+    lines, as in a SYNC delta, and of "!username,milliseconds" lines
+    for the users who left with a LEAVE. A new journal generation is started at every startup
+    and every snapshot, so a file torn by a crash is never appended to.
+    """
+    SYNC_INTERVAL = 1.0
+    #journal records after which a new snapshot should be written
+    SNAPSHOT_RECORDS = 100000
+
+    def __init__(self,path,sync=SYNC_GROUP,interval=SYNC_INTERVAL,snapshot_records=SNAPSHOT_RECORDS):
+        if sync not in SYNC_POLICIES:
+            raise JournalError("unknown fsync policy %s"%sync)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.path=path
+        self.sync=sync
+        self.interval=interval
+        self.snapshot_records=snapshot_records
+
+        #current journal file, its generation and the records it holds
+        self.__fd=None
+        self.__generation=0
+        self.__records=0
+        #records appended but not written yet, sequence number of the
+        #last appended record and of the last one safely on disk
+        self.__buffer=[]
+        self.__appended=0
+        self.__durable=0
+        #(ticket,callback) of the commits waiting for their records
+        self.__waiters=[]
+        #JournalError set once the journal can't be written any more
+        self.__error=None
+        self.__closed=False
+        self.__cond=threading.Condition()
+        #held while writing to the journal file, or replacing it
+        self.__file_lock=threading.Lock()
+        self.__flusher=None
+
+        #number of fsyncs, and of appends they covered
+        self.fsyncs=0
+        self.synced=0
+        #entries, replayed records and duration of the last recovery
+        self.recovered=0
+        self.replayed=0
+        self.recovery_time=None
+
+        self.__logger=logging.getLogger("journal")
+
+    def recover(self):
+        """
+        Load the snapshot and replay the journals written after it,
+        then start a new journal. Returns a tuple
+        (entries,names,revoked,payload) where entries maps usernames to
+        (username,address,port), names are the usernames sorted, revoked
+        maps usernames to the time of their last LEAVE in milliseconds,
+        and payload is the snapshot body when it is also the RESULT
+        payload of the entries, None if journals were replayed.
+        """
+        started=time.time()
+        #the recovery allocates millions of objects, none of which
+        #can be part of a reference cycle
+        collecting=gc.isenabled()
+        gc.disable()
+        try:
+            first,entries,names,revoked,payload=self.__load_snapshot()
+
+            generations=self.__generations()
+            for g in generations:
+                if g<first:
+                    #already part of the snapshot, left by a crash while compacting
+                    os.unlink(self.__journal_path(g))
+            generations=[g for g in generations if g>=first]
+
+            added=set()
+            for g in generations:
+                self.replayed+=self.__replay(g,entries,added,revoked)
+            if self.replayed:
+                payload=None
+                #the snapshot names are sorted already: drop those that
+                #left and merge those that joined, rather than sorting
+                #all the entries again
+                joined=[username for username in added if username in entries and not self.__contains(names,username)]
+                names=[username for username in names if username in entries]
+                names.extend(joined)
+                names.sort()
+        finally:
+            if collecting:
+                gc.enable()
+
+        self.recovered=len(entries)
+        self.recovery_time=time.time()-started
+        self.__logger.info("recovered %d entries, %d journal records replayed, in %.3fs"%(self.recovered,self.replayed,self.recovery_time))
+
+        self.__open(max(generations+[first-1])+1)
+        #the replayed journals are only dropped by the next snapshot
+        self.__records=self.replayed
+        self.__flusher=threading.Thread(target=self.__run,name="journal")
+        self.__flusher.daemon=True
+        self.__flusher.start()
+        return entries,names,revoked,payload
+
+    def append(self,changes,revoked=()):
+        """
+        Log a list of (username,entry) changes, entry being None for
+        the users that left, and of (username,milliseconds) session
+        revocations. Called with the directory lock held, so that the
+        journal follows the order of the changes. Returns the ticket
+        to pass to commit().
+        """
+        lines="".join([("+%s,%s,%d\n"%entry if entry!=None else "-%s\n"%username) for username,entry in changes])
+        if revoked:
+            lines+="".join(["!%s,%d\n"%revocation for revocation in revoked])
+        changes=len(changes)+len(revoked)
+
+        with self.__cond:
+            if self.__error==None:
+                self.__buffer.append(lines)
+            self.__appended+=1
+            self.__records+=changes
+            self.__cond.notify_all()
+            return self.__appended
+
+    def commit(self,ticket,callback=None):
+        """
+        Wait, if the policy requires it, until the changes of the
+        ticket are on disk. Must not be called with the directory
+        lock held, so that other changes can join the same fsync.
+        If a callback is given, commit returns at once instead, and
+        the callback is called with None once the changes are on disk,
+        possibly from the flusher thread. Once the journal can't be
+        written, e.g. out of disk space, the commits of the changes
+        not on disk fail: commit raises the JournalError, or passes
+        it to the callback.
+        """
+        error=None
+        if ticket!=None:
+            with self.__cond:
+                if self.sync!=SYNC_PERIODIC:
+                    if callback!=None and self.__durable<ticket and not self.__closed and self.__error==None:
+                        self.__waiters.append((ticket,callback))
+                        return
+                    while self.__durable<ticket and not self.__closed and self.__error==None:
+                        self.__cond.wait()
+                if self.__durable<ticket:
+                    error=self.__error
+        if callback!=None:
+            callback(error)
+        elif error!=None:
+            raise error
+
+    def needs_snapshot(self):
+        return self.__error==None and self.__records>=self.snapshot_records
+
+    def rotate(self):
+        """
+        Start a new journal generation, once everything appended to
+        the current one is on disk. Called with the directory lock
+        held: the snapshot to write is the state at this point.
+        Returns the generation of the new journal, or raises the
+        JournalError of a journal that can't be written.
+        """
+        failure=None
+        with self.__file_lock:
+            if self.__error!=None:
+                raise self.__error
+            with self.__cond:
+                lines="".join(self.__buffer)
+                self.__buffer=[]
+                appended=self.__appended
+            try:
+                self.__write(lines)
+                os.fsync(self.__fd)
+                os.close(self.__fd)
+                self.__fd=None
+                self.__open(self.__generation+1)
+            except (OSError,IOError),e:
+                failure=e
+        if failure!=None:
+            raise self.__fail(failure)
+
+        self.__settle(appended)
+        return self.__generation
+
+    def write_snapshot(self,generation,names,entries,revoked=None):
+        """
+        Write the snapshot of the entries, made when the journal
+        generation was started, and delete the journals it replaces.
+        names are the usernames, sorted, and revoked maps usernames
+        to the time of their last LEAVE, in milliseconds.
+        """
+        revoked=revoked or dict()
+        started=time.time()
+        target=os.path.join(self.path,"snapshot")
+        temporary=target+".tmp"
+
+        with open(temporary,"wb") as f:
+            f.write("#snapshot %d %d %d\n"%(generation,len(names),len(revoked)))
+            f.write("".join(["!%s,%d\n"%revocation for revocation in revoked.items()]))
+            f.write("\n".join(["%s,%s,%d"%entries[username] for username in names]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary,target)
+        self.__sync_folder()
+
+        for g in self.__generations():
+            if g<generation:
+                os.unlink(self.__journal_path(g))
+        self.__logger.info("snapshot of %d entries written in %.3fs"%(len(names),time.time()-started))
+
+    def close(self):
+        """
+        Write and fsync the pending records, and stop the flusher
+        """
+        with self.__cond:
+            self.__closed=True
+            self.__cond.notify_all()
+        if self.__flusher!=None:
+            self.__flusher.join()
+        failure=None
+        with self.__file_lock:
+            if self.__fd!=None:
+                try:
+                    if self.__error==None:
+                        self.__write("".join(self.__buffer))
+                        self.__buffer=[]
+                        os.fsync(self.__fd)
+                    os.close(self.__fd)
+                except (OSError,IOError),e:
+                    failure=e
+                self.__fd=None
+        if failure!=None:
+            self.__fail(failure)
+        if self.__error==None:
+            self.__settle(self.__appended)
+
+    def __run(self):
+        """
+        Body of the flusher thread. Whatever was appended while the
+        previous fsync ran is written and fsynced at once, unless
+        every change has to be fsynced on its own.
+        """
+        while True:
+            with self.__cond:
+                while not self.__buffer and not self.__closed:
+                    self.__cond.wait()
+                if self.__closed:
+                    return
+
+            failure=None
+            with self.__file_lock:
+                with self.__cond:
+                    taken=self.__buffer[:1] if self.sync==SYNC_ALWAYS else self.__buffer
+                    self.__buffer=self.__buffer[len(taken):]
+                    lines="".join(taken)
+                    covered=len(taken)
+                    #sequence number of the last record taken
+                    appended=self.__appended-len(self.__buffer)
+                try:
+                    self.__write(lines)
+                    os.fsync(self.__fd)
+                except (OSError,IOError),e:
+                    failure=e
+            if failure!=None:
+                self.__fail(failure)
+                return
+            self.fsyncs+=1
+            self.synced+=covered
+            self.__settle(appended)
+
+            if self.sync==SYNC_PERIODIC:
+                time.sleep(self.interval)
+
+    def __fail(self,failure):
+        """
+        Record that the journal can't be written any more. The changes
+        not on disk yet and all the later ones are lost: their commits
+        fail, starting with those waiting. Returns the JournalError.
+        """
+        with self.__cond:
+            if self.__error==None:
+                self.__error=JournalError("journal %d can't be written: %s"%(self.__generation,str(failure)))
+                self.__logger.error("%s, changes are not persisted any more"%str(self.__error))
+            self.__buffer=[]
+            self.__cond.notify_all()
+            waiters,self.__waiters=self.__waiters,[]
+        for ticket,callback in waiters:
+            callback(self.__error)
+        return self.__error
+
+    def __settle(self,appended):
+        """
+        Record that everything up to the sequence number appended is
+        on disk, waking the commits waiting for it. The callbacks are
+        called without holding any lock.
+        """
+        with self.__cond:
+            self.__durable=max(self.__durable,appended)
+            self.__cond.notify_all()
+            ready=[callback for ticket,callback in self.__waiters if ticket<=self.__durable or self.__closed]
+            if ready:
+                self.__waiters=[(ticket,callback) for ticket,callback in self.__waiters if ticket>self.__durable and not self.__closed]
+        for callback in ready:
+            callback(None)
+
+    def __write(self,data):
+        while data:
+            written=os.write(self.__fd,data)
+            data=buffer(data,written)
+
+    def __open(self,generation):
+        self.__generation=generation
+        self.__records=0
+        self.__fd=os.open(self.__journal_path(generation),os.O_WRONLY|os.O_CREAT|os.O_APPEND,0644)
+        self.__sync_folder()
+
+    def __sync_folder(self):
+        """
+        Make the creation or renaming of files durable
+        """
+        fd=os.open(self.path,os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def __journal_path(self,generation):
+        return os.path.join(self.path,"journal.%d"%generation)
+
+    def __generations(self):
+        return sorted([int(name[len("journal."):]) for name in os.listdir(self.path)
+                       if name.startswith("journal.") and name[len("journal."):].isdigit()])
+
+    def __contains(self,names,username):
+        i=bisect.bisect_left(names,username)
+        return i<len(names) and names[i]==username
+
+    def __load_snapshot(self):
+        """
+        Map the snapshot file and parse it column by column, which
+        keeps the per entry work in C. If the columns don't line up,
+        it is parsed again line by line, skipping the invalid ones.
+        Returns a tuple (first journal generation not included,entries,
+        sorted usernames,revocations,payload).
+        """
+        target=os.path.join(self.path,"snapshot")
+        if not os.path.exists(target) or os.path.getsize(target)==0:
+            return 1,dict(),[],dict(),None
+
+        revoked=dict()
+        with open(target,"rb") as f:
+            m=mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+            try:
+                end=m.find("\n")
+                header=(m[:end] if end>=0 else m[:]).split()
+                if len(header) not in (3,4) or header[0]!="#snapshot" or not all([field.isdigit() for field in header[1:]]):
+                    raise JournalError("invalid snapshot header in %s"%target)
+                #the revocations, missing from the snapshots written
+                #before they were persisted, then the body
+                for i in range(int(header[3]) if len(header)==4 else 0):
+                    start=end+1
+                    end=m.find("\n",start)
+                    if end<0:
+                        raise JournalError("snapshot %s misses revocations"%target)
+                    self.__parse_revocation(m[start+1:end],revoked)
+                body=m[end+1:] if end>=0 else ""
+            finally:
+                m.close()
+
+        if not body:
+            return int(header[1]),dict(),[],revoked,None
+
+        count=int(header[2])
+        fields=body.replace("\n",",").split(",")
+        try:
+            if len(fields)!=3*count or body.count("\n")!=count-1:
+                raise ValueError("%d fields for %d entries"%(len(fields),count))
+            usernames=fields[0::3]
+            entries=dict(zip(usernames,zip(usernames,fields[1::3],map(int,fields[2::3]))))
+        except ValueError,e:
+            self.__logger.warning("snapshot %s is not well formed (%s), parsing it line by line"%(target,str(e)))
+            entries=dict()
+            for line in body.split("\n"):
+                self.__parse_entry(line,entries)
+            usernames=sorted(entries)
+            if len(entries)!=count:
+                self.__logger.warning("skipped %d invalid entries of snapshot %s"%(count-len(entries),target))
+            #the body lists the invalid entries too
+            body=None
+        return int(header[1]),entries,usernames,revoked,body
+
+    def __replay(self,generation,entries,added,revoked):
+        """
+        Apply the records of a journal, collecting in added the users
+        registered and in revoked the time of their last LEAVE. A last
+        line without its newline was torn by a crash, and is ignored,
+        as are the invalid records, e.g. of a username with a comma
+        written before those were refused.
+        """
+        with open(self.__journal_path(generation),"rb") as f:
+            data=f.read()
+
+        lines=data.split("\n")
+        if lines[-1]:
+            self.__logger.warning("ignoring the torn record at the end of journal %d"%generation)
+        lines=lines[:-1]
+
+        skipped=0
+        for line in lines:
+            if line.startswith("+"):
+                username=self.__parse_entry(line[1:],entries)
+                if username!=None:
+                    added.add(username)
+                else:
+                    skipped+=1
+            elif line.startswith("-"):
+                entries.pop(line[1:],None)
+            elif not line.startswith("!") or not self.__parse_revocation(line[1:],revoked):
+                skipped+=1
+        if skipped:
+            self.__logger.warning("skipped %d invalid records in journal %d"%(skipped,generation))
+        return len(lines)
+
+    def __parse_entry(self,line,entries):
+        """
+        Add the entry "username,address,port" to entries. Returns the
+        username, or None if the line is not a valid entry.
+        """
+        fields=line.split(",")
+        if len(fields)!=3 or not fields[0] or not fields[2].isdigit():
+            return None
+        username,address,port=fields
+        entries[username]=(username,address,int(port))
+        return username
+
+    def __parse_revocation(self,line,revoked):
+        """
+        Add the revocation "username,milliseconds" to revoked. Returns
+        false if the line is not a valid revocation.
+        """
+        fields=line.split(",")
+        if len(fields)!=2 or not fields[1].isdigit():
+            return False
+        revoked[fields[0]]=int(fields[1])
+        return True
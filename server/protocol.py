@@ -11,27 +11,80 @@ Corrado Leita - corrado_leita@symantec.com
 ================================================
 Wrapper to simplify protocol interaction
 '''
-import logging,socket
+import logging,socket,threading,select,errno
 import parsing as p
 
+from collections import deque
+
+
+class TransportStats:
+    """
+    Counters of the outgoing traffic of one or more connections,
+    to measure how well the writes are coalesced
+    """
+    
+    def __init__(self):
+        self.messages=0
+        self.bytes=0
+        self.syscalls=0
+        self.__lock=threading.Lock()
+    
+    def add(self,other):
+        """
+        Merge the counters of a closed connection
+        """
+        with self.__lock:
+            self.messages+=other.messages
+            self.bytes+=other.bytes
+            self.syscalls+=other.syscalls
+    
+    def __str__(self):
+        per_message=float(max(self.messages,1))
+        return "%d messages, %d bytes, %.1f bytes/message, %.2f send calls/message"%(
+            self.messages,self.bytes,self.bytes/per_message,self.syscalls/per_message)
+
+
+#counters of all the connections closed so far
+totals=TransportStats()
+
+
 class ProtocolWrapper:
     """
     Wrap a socket object and simplify
     the socket interaction. All the methods can 
     raise a socket.timeout, that needs to be handled 
-    by the caller.
+    by the caller. Messages can be sent from several
+    threads at the same time.
+    Requests may be pipelined by the client: while more
+    of them are already buffered, the answers are held
+    back and written all together, with a single send.
     """
+    #disable Nagle's algorithm: writes are already coalesced here,
+    #and it would only delay the last segment of every answer
+    NODELAY=True
+    #answers held back are written anyway once they exceed this size
+    FLUSH_SIZE=65536
     
-    def __init__(self,socket,addrinfo):
-        self.__sock=socket
+    def __init__(self,sock,addrinfo):
+        self.__sock=sock
         self.__address=addrinfo
         
-        #the receiving buffer
-        self.__buffer=""
+        #decoder of the received stream, and the messages
+        #decoded but not returned yet
+        self.__decoder=p.StreamDecoder()
+        self.__messages=deque()
+        #buffers of the messages not written yet, and their size
+        self.__outgoing=[]
+        self.__outgoing_size=0
+        #counters of the outgoing traffic
+        self.stats=TransportStats()
+        #serialize the senders, so that messages are never interleaved
+        self.__send_lock=threading.Lock()
         #the logger for the object
         self.__logger=logging.getLogger("endpoint.%s:%d"%self.__address)
         #set a timeout for the socket. Don't block for more than 30s
         self.__sock.settimeout(30)
+        self.__sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,ProtocolWrapper.NODELAY)
         
         self.__logger.debug("new connection")
         
@@ -41,14 +94,14 @@ class ProtocolWrapper:
         """
         Tries to receive one complete message from the buffer.
         Returns None if client disconnected or if an error occurred.
+        Raises a ParseError if the client does not follow the protocol.
         """
-        msg=None
-        
         #continue to receive until at least one message is produced
-        while msg==None:
+        while not self.__messages:
+            #the answers must be out before waiting for new requests
+            self.flush()
             try:
                 pay=self.__sock.recv(1024)
-                self.__buffer+=pay
                 
                 #client may have disconnected
                 if not pay:     break
@@ -56,25 +109,116 @@ class ProtocolWrapper:
                 self.__logger.error("receive error: %s"%str(e))
                 break
             
-            self.__buffer,msg=p.parse(self.__buffer)
+            self.__messages.extend(self.__decoder.feed(pay))
         
-        return msg
+        return self.__messages.popleft() if self.__messages else None
+    
+    def pending(self):
+        """
+        Number of received requests not returned by recv yet
+        """
+        return len(self.__messages)
     
     def send(self,message_type,message_args=[],message_payload=""):
         """
-        Returns true if the send was successful
+        Returns true if the send was successful. The message is
+        held back if more requests are buffered, and written
+        together with their answers.
+        """
+        m=p.Message(message_type,message_args,message_payload)
+        
+        with self.__send_lock:
+            for b in m.encode():
+                self.__outgoing.append(b)
+                self.__outgoing_size+=len(b)
+            self.stats.messages+=1
+            if self.__messages and self.__outgoing_size<ProtocolWrapper.FLUSH_SIZE:
+                return True
+            return self.__flush()
+    
+    def send_nowait(self,message_type,message_args=[],message_payload=""):
+        """
+        Send a message without ever blocking, for the threads that
+        must not wait for a client. Returns None if another thread
+        is sending, and nothing is written then. Returns false if
+        the client does not read fast enough to take the message at
+        once: it may be cut in its middle, the connection must be
+        shut down.
         """
         m=p.Message(message_type,message_args,message_payload)
         
+        if not self.__send_lock.acquire(False):
+            return None
+        try:
+            for b in m.encode():
+                self.__outgoing.append(b)
+                self.__outgoing_size+=len(b)
+            self.stats.messages+=1
+            if self.__messages:
+                #written with the answers held back, by the receiving thread
+                return True
+            return self.__flush(False)
+        finally:
+            self.__send_lock.release()
+    
+    def flush(self):
+        """
+        Write the messages held back, if any.
+        Returns true if the send was successful
+        """
+        with self.__send_lock:
+            return self.__flush()
+    
+    def __flush(self,wait=True):
+        if not self.__outgoing:
+            return True
+        
+        chunks=p.gather(self.__outgoing)
+        del self.__outgoing[:]
+        self.__outgoing_size=0
         try:
-            #shortcut to ensure we have sent all the payload.
-            #it calls send multiple times until all the data has been sent
-            self.__sock.sendall(str(m))
+            #same as sendall, but counting the calls
+            for chunk in chunks:
+                while chunk:
+                    sent=self.__sock.send(chunk) if wait else self.__send_now(chunk)
+                    if sent==0:
+                        self.__logger.error("send error: the client does not read")
+                        return False
+                    self.stats.syscalls+=1
+                    self.stats.bytes+=sent
+                    chunk=buffer(chunk,sent) if sent<len(chunk) else None
             return True
         except socket.error,e:
             self.__logger.error("send error: %s"%str(e))
             return False
     
+    def __send_now(self,chunk):
+        """
+        Write what the socket takes of chunk without waiting.
+        Returns 0 if it is full.
+        """
+        #a socket with a timeout first waits until it is writable
+        poller=select.poll()
+        poller.register(self.__sock,select.POLLOUT)
+        if not poller.poll(0):
+            return 0
+        try:
+            return self.__sock.send(chunk,socket.MSG_DONTWAIT)
+        except socket.error,e:
+            if e.errno in (errno.EAGAIN,errno.EWOULDBLOCK):
+                return 0
+            raise
+    
+    def shutdown(self):
+        """
+        Shut the connection down from another thread, without
+        waiting: the receiving thread then sees it closed.
+        """
+        try:
+            self.__sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+    
     def close(self,failure=None):
         """
         Shutdown the socket. If a failure string is provided, 
@@ -85,5 +229,7 @@ class ProtocolWrapper:
             #send an error message, or at least try to...
             self.send(p.T_ERR,[],failure)
         
-        self.__logger.debug("closing connection")
+        self.flush()
+        self.__logger.debug("closing connection (%s)"%self.stats)
+        totals.add(self.stats)
         self.__sock.close()
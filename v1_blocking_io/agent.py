@@ -39,6 +39,9 @@ class Agent:
         # Authenticate the user and bind to port for chatting
         self.__client.authenticate()
 
+        # Keep the list of online users current
+        self.__client.subscribe()
+
     
     def prompt(self, showIntro = False):
         """ Start the simple prompt that acccepts user input.
@@ -70,6 +73,14 @@ class Agent:
                         self.__result = self.__client.search(match.group(1))
                     else:
                         self.__result = self.__client.listAll()
+                elif (input.find('find') == 0):
+                    match = re.search('^find ?([a-zA-Z0-9]*)$', input)
+                    if (match):
+                        self.__result = self.__client.browse(match.group(1))
+                elif re.search("^more$", input):
+                    self.__result = self.__client.browseMore()
+                elif re.search("^peers$", input):
+                    self.__client.peerStats()
                 elif (input.find('ping') == 0):
                     match = re.search('^ping ([a-zA-Z0-9]+)$', input)
                     if (match):
@@ -84,7 +95,10 @@ class Agent:
                     self.printMessage("chat user message    : Chat with another user.", "help")
                     self.printMessage("secret user message  : Get final secret from bot_user", "help")
                     self.printMessage("list                 : List all online users.", "help")
+                    self.printMessage("find prefix          : List the online users starting with prefix.", "help")
+                    self.printMessage("more                 : Next page of the last find.", "help")
                     self.printMessage("ping user            : Ping user.", "help")
+                    self.printMessage("peers                : Connection statistics of the users contacted.", "help")
                     self.printMessage("bye                  : I think its obvious ;)", "help")
                 else:
                     raise Exception
@@ -0,0 +1,194 @@
+#
+# benchmark.py
+#
+# @author       : Vidros Sokratis <vidros@eurecom.fr>
+# @date         : 9-1-2012
+# @copyright    : Copyright (c) 2012 Vidros Sokratis
+# @license      : http://creativecommons.org/licenses/by-nd-nc/1.0/
+# @version      : 1.0
+# @description  : Load checks of the chat server
+#
+
+import sys
+import time
+import random
+import socket
+import threading
+import parsing as p
+
+from chatServer import ChatServer
+
+
+
+class CountingAgent:
+    """ Stands for the agent, counting the messages shown instead of printing them """
+
+    def __init__(self, record = False):
+        self.received = 0
+        self.errors = []
+        self.messages = [] if record else None   # (sender, payload) in order of delivery
+        self.__done = threading.Event()
+        self.__expected = None
+
+    def expect(self, count):
+        self.__expected = count
+
+    def wait(self, timeout):
+        self.__done.wait(timeout)
+
+    def printMessage(self, msg, args = ""):
+        if args == "Server Error":
+            self.errors.append(msg)
+            return
+        self.received += 1
+        if self.messages is not None:
+            self.messages.append((args, msg))
+        if self.received == self.__expected:
+            self.__done.set()
+
+
+def checkPeers(peers, messages, timeout):
+    """ Connect peers at the same time to one ChatServer, and have all of them send
+        their messages at once, followed by a PING. Returns the number of messages
+        delivered to the agent, the number of PONGs received back, the errors
+        reported by the server and the elapsed time. """
+
+    agent = CountingAgent()
+    agent.expect(peers * messages)
+    server = ChatServer('127.0.0.1', 'bench', agent)
+    server.start()
+    address = ('127.0.0.1', server.getServerPort())
+
+    go = threading.Event()
+    pongs = [0]
+    lock = threading.Lock()
+
+    def peer(n):
+        s = socket.create_connection(address)
+        go.wait()
+        s.sendall("".join([ str(p.Message(p.T_MESSAGE, ["peer%d" % n], "message %d from peer %d" % (i, n))) for i in range(messages) ]))
+        s.sendall(str(p.Message(p.T_PING, ["peer%d" % n])))
+
+        buf = ''
+        reply = None
+        s.settimeout(timeout)
+        while reply is None:
+            data = s.recv(1024)
+            if not data:
+                break
+            buf, reply = p.parse(buf + data)
+        if reply is not None and reply.type == p.T_PONG:
+            with lock:
+                pongs[0] += 1
+        s.close()
+
+    threads = [ threading.Thread(target = peer, args = (n,)) for n in range(peers) ]
+    [ t.start() for t in threads ]
+    # Let every peer connect before they all start sending
+    time.sleep(0.5)
+
+    started = time.time()
+    go.set()
+    agent.wait(timeout)
+    [ t.join() for t in threads ]
+    elapsed = time.time() - started
+
+    return agent.received, pongs[0], agent.errors, elapsed
+
+
+def peersSuite(values):
+    print "%d peers sending %d messages each at the same time" % (values.peers, values.messages)
+    received, pongs, errors, elapsed = checkPeers(values.peers, values.messages, values.timeout)
+    print "delivered %d/%d messages, %d/%d PONGs, %d errors, %.2fs (%.0f messages/s)" % (
+        received, values.peers * values.messages, pongs, values.peers, len(errors), elapsed, received / elapsed)
+    return received == values.peers * values.messages and pongs == values.peers and not errors
+
+
+def checkBurst(peers, frames, timeout):
+    """ Have a few peers each send a burst of MESSAGE frames of random size, cut in
+        chunks of random size so that frames are split across reads and many of
+        them arrive in one read. Returns the number of frames delivered, whether
+        every peer's frames were delivered complete and in order, the number of
+        bytes sent and the elapsed time. """
+
+    agent = CountingAgent(record = True)
+    agent.expect(peers * frames)
+    server = ChatServer('127.0.0.1', 'bench', agent)
+    server.start()
+    address = ('127.0.0.1', server.getServerPort())
+
+    bursts = []
+    for n in range(peers):
+        payloads = [ "%d:%s" % (i, "x" * random.randint(0, 512)) for i in range(frames) ]
+        data = "".join([ str(p.Message(p.T_MESSAGE, ["peer%d" % n], payload)) for payload in payloads ])
+        bursts.append((payloads, data))
+
+    def peer(n):
+        s = socket.create_connection(address)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        data = bursts[n][1]
+        pos = 0
+        while pos < len(data):
+            chunk = random.randint(1, 3000)
+            s.sendall(data[pos:pos + chunk])
+            pos += chunk
+        agent.wait(timeout)
+        s.close()
+
+    threads = [ threading.Thread(target = peer, args = (n,)) for n in range(peers) ]
+    started = time.time()
+    [ t.start() for t in threads ]
+    agent.wait(timeout)
+    elapsed = time.time() - started
+    [ t.join() for t in threads ]
+
+    inOrder = True
+    for n in range(peers):
+        received = [ payload for sender, payload in agent.messages if sender == "peer%d" % n ]
+        inOrder = inOrder and received == bursts[n][0]
+
+    return agent.received, inOrder, sum([ len(b[1]) for b in bursts ]), elapsed
+
+
+def burstSuite(values):
+    print "%d peers bursting %d MESSAGE frames each" % (values.burst_peers, values.frames)
+    received, inOrder, size, elapsed = checkBurst(values.burst_peers, values.frames, values.timeout)
+    print "delivered %d/%d frames, %s, %.2fs (%.0f frames/s, %.1f MB/s)" % (
+        received, values.burst_peers * values.frames, "in order" if inOrder else "OUT OF ORDER",
+        elapsed, received / elapsed, size / elapsed / 1e6)
+    return received == values.burst_peers * values.frames and inOrder
+
+
+def raiseFdLimit():
+    """ Each peer costs two sockets in this process, beyond the usual soft limit """
+
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError):
+        pass
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    op = OptionParser()
+    op.add_option("-p", "--peers", dest = "peers", type = "int", default = 500, help = "Number of peers sending at the same time")
+    op.add_option("-m", "--messages", dest = "messages", type = "int", default = 10, help = "Messages sent by each peer")
+    op.add_option("-f", "--frames", dest = "frames", type = "int", default = 20000, help = "Frames in each burst")
+    op.add_option("-b", "--burst-peers", dest = "burst_peers", type = "int", default = 4, help = "Number of peers bursting at the same time")
+    op.add_option("-t", "--timeout", dest = "timeout", type = "int", default = 30, help = "Seconds to wait for all the messages")
+    op.add_option("-s", "--suite", dest = "suite", type = "choice", choices = ["all", "peers", "burst"], default = "all", help = "Check to run")
+
+    (values, args) = op.parse_args()
+    raiseFdLimit()
+
+    ok = True
+    suites = [("peers", peersSuite), ("burst", burstSuite)]
+    for name, suite in suites:
+        if values.suite in ("all", name):
+            ok = suite(values) and ok
+
+    sys.exit(0 if ok else 1)
@@ -12,17 +12,115 @@
 
 import re
 import sys
+import Queue
+import socket
+import threading
 import parsing as p
 
-from time import sleep
+from time import sleep, time
+from collections import deque
 from connectionManager import ConnectionManager
+from connectionPool import ConnectionPool
 
 
 
+class DirectorySession:
+    """ Long lived, authenticated session with the directory server. A reader thread
+        answers the keepalive PINGs of the directory, sends its own when nothing was
+        sent for KEEPALIVE seconds, since the directory drops the sessions it hears
+        nothing from, however many NOTIFYs it pushes over them, and hands the pushed NOTIFY messages to a callback. Every other message is
+        the reply to the oldest request still waiting for one: each request waits on
+        its own slot, so concurrent requests never take each other's replies. """
+
+    REPLY_TIMEOUT = 10
+    KEEPALIVE = 10                      # Seconds without sending anything before a PING
+
+    def __init__(self, cm, onNotify, onClose):
+        self.__cm = cm
+        self.__onNotify = onNotify
+        self.__onClose = onClose
+        self.__waiting = deque()            # Reply slots of the requests sent, oldest first
+        self.__lock = threading.Lock()
+        self.__lastSent = time()
+
+        reader = threading.Thread(target = self.__read)
+        reader.daemon = True
+        reader.start()
+
+    def isClosed(self):
+        return self.__cm.isClosed()
+
+    def send(self, msgType, msgArgs = []):
+        """ Send a message that does not expect a reply """
+
+        with self.__lock:
+            self.__lastSent = time()
+            self.__cm.send(msgType, msgArgs)
+
+    def request(self, msgType, msgArgs = []):
+        """ Send a request and wait for its reply. Returns None if the session is lost. """
+
+        slot = Queue.Queue(1)
+        with self.__lock:
+            self.__waiting.append(slot)
+            self.__lastSent = time()
+            self.__cm.send(msgType, msgArgs)
+
+        try:
+            return slot.get(timeout = self.REPLY_TIMEOUT)
+        except Queue.Empty:
+            # A late reply would be taken for the reply to the next request
+            self.close()
+            return None
+
+    def close(self):
+        self.__cm.disconnect()
+
+    def __read(self):
+        """ Body of the reader thread """
+
+        while True:
+            msg = self.__cm.receive()
+            if time() - self.__lastSent >= self.KEEPALIVE and not self.__cm.isClosed():
+                # Nothing sent for a while, show the directory we are alive
+                self.send(p.T_PING)
+            if msg is None:
+                if self.__cm.isClosed():
+                    break
+            elif msg.type == p.T_PING:
+                self.send(p.T_PONG)
+            elif msg.type == p.T_PONG:
+                pass
+            elif msg.type == p.T_NOTIFY:
+                self.__onNotify(msg)
+            else:
+                with self.__lock:
+                    if not self.__waiting:
+                        # Not a reply, the directory is closing the session
+                        continue
+                    slot = self.__waiting.popleft()
+                slot.put(msg)
+
+        # Wake up the requests still waiting
+        with self.__lock:
+            waiting, self.__waiting = self.__waiting, deque()
+        [ slot.put(None) for slot in waiting ]
+        self.__onClose(self)
+
+
 class ChatClient:
     """ Chat client handles all outcoming requests like (authentication, user searching and of course chatting. The general idea of the client is to
     open a connection for sending messages and receive all the incoming messages
-    at the server port that is known through the directory server."""
+    at the server port that is known through the directory server.
+    All the directory commands go through one authenticated session, which is
+    opened again only when it drops. The session token received with the
+    binding then restores both the login and the binding in one round trip.
+    When the directory grants the binding as a lease, it is renewed halfway
+    through its duration."""
+
+    RESUBSCRIBE_WAIT = 5
+    RENEW_RETRY = 5                     # Seconds before renewing again after a failure
+    PAGE_SIZE = 20
 
     def __init__(self, host, port, username, password, agent):
         self.__host = host
@@ -30,36 +128,117 @@ class ChatClient:
         self.__username = username
         self.__password = password
         self.__agent = agent
-        self.__cm = None
+        self.__session = None           # Current DirectorySession
+        self.__sessionLock = threading.Lock()
+        self.__bindPort = None          # Port of the local server, once bound
+        self.__sessionToken = None      # Token to resume the binding with on a new session
+        self.__renewTimer = None        # Sends the next RENEW, while the binding is a lease
+        self.__subscribed = False
+        self.__peers = ConnectionPool()  # Open connections to the other users
         self.__userList = {}
+        self.__syncToken = None         # Version of the user list, as named by the directory
+        self.__browsePrefix = None      # Prefix and cursor of the last page browsed
+        self.__browseCursor = None
+
+    def __getSession(self):
+        """ Return the directory session, opening it and logging in if it is not
+            open yet or if it dropped """
+
+        with self.__sessionLock:
+            if self.__session is None or self.__session.isClosed():
+                self.__session = self.__openSession()
+            return self.__session
+
+    def __openSession(self):
+        """ Connect and log in, then restore the binding and the subscription
+            of the session that dropped, if any """
+
+        cm = ConnectionManager(self.__host, self.__port, socket.create_connection((self.__host, self.__port), ConnectionManager.TIMEOUT))
+        resumed = self.__bindPort is not None and self.__resumeOn(cm)
+        if not resumed:
+            self.__authenticateOn(cm)
+        session = DirectorySession(cm, self.__notified, self.__sessionClosed)
+
+        if self.__bindPort is not None and not resumed:
+            reply = session.request(p.T_BIND, [self.__host, self.__bindPort])
+            if (reply is None or reply.type != p.T_ACK):
+                raise Exception, "Port binding was not succussful!"
+            self.__keepBinding(reply)
 
-    def __connect(self):
-        self.__cm = ConnectionManager(self.__host, self.__port)
-        self.__cm.connect()
-        
-    def __disconnect(self):
-        self.__cm.disconnect()
+        if self.__subscribed:
+            session.request(p.T_SUBSCRIBE, [self.__syncToken] if self.__syncToken else [])
+
+        return session
 
-    def __trigger(self, toBeExecuted, args = []):
-        """ Trigger function uses the power of functinal programing to execute the functions 
-            that are passed as parameters. In details, its a wrapper for every command that
-            requires re-authentication with the directory server. """
+    def __request(self, msgType, msgArgs = []):
+        """ Send a request to the directory and return its reply. A request that
+            finds the session lost is sent once more on a new session. """
 
-        self.__connect()
-        [ f(args) for f in toBeExecuted ]
-        self.__disconnect()
+        reply = self.__getSession().request(msgType, msgArgs)
+        if reply is None:
+            reply = self.__getSession().request(msgType, msgArgs)
+        return reply
+
+    def __sessionClosed(self, session):
+        """ Called by the reader thread when the session drops. While subscribed,
+            a new session is opened after a short wait to keep receiving changes. """
+
+        if self.__subscribed and session is self.__session:
+            t = threading.Timer(self.RESUBSCRIBE_WAIT, self.__resubscribe)
+            t.daemon = True
+            t.start()
+
+    def __resubscribe(self):
+        try:
+            self.__getSession()
+        except Exception, e:
+            self.__sessionClosed(self.__session)
 
     def authenticate(self):
-        self.__trigger([self.__login, self.__bind])
+        try:
+            self.__getSession()
+            self.__bind()
+
+        except Exception,e:
+            self.__handleError('Authenticate', e)
 
     def search(self, username):
-        self.__trigger([self.__login, self.__searchUser], [username])
+        self.__searchUser([username])
 
     def listAll(self):
-        self.__trigger([self.__login, self.__searchUser])
+        self.__syncUsers()
 
     def leave(self):
-        self.__trigger([self.__login, self.__unregister])
+        self.__unregister()
+        self.__peers.closeAll()
+
+    def browse(self, prefix = ""):
+        """ Show the first page of the users whose name starts with prefix """
+
+        self.__browsePrefix = prefix
+        self.__browseCursor = None
+        self.__browseUsers()
+
+    def browseMore(self):
+        """ Show the next page of the last browsed users """
+
+        if self.__browseCursor is None:
+            self.__handleError('Find', 'No more users to show')
+        else:
+            self.__browseUsers()
+
+    def subscribe(self):
+        """ Ask the directory to push the users joining or leaving on the session.
+            The user list and the side panel then stay current without listing again. """
+
+        try:
+            self.__subscribed = True
+            reply = self.__request(p.T_SUBSCRIBE, [self.__syncToken] if self.__syncToken else [])
+            if (reply is None or reply.type != p.T_ACK):
+                raise Exception, "Unable to follow the user list"
+
+        except Exception,e:
+            self.__handleError('Subscribe', e)
 
     def chat(self, username, message, getSecret = False):
         """ Start chatting with a specific user """
@@ -70,13 +249,11 @@ class ChatClient:
 
             if (username in self.__userList):
    
-                # Setup a new socket connection with the other user and send data.
+                # Send the message on the connection to the other user, opened on first use.
                 # The user can reply at the binded port from the directory server
                 uIp, uP = self.__userList[username]
-                c = ConnectionManager(uIp, uP)
-                c.connect()
-                c.send(p.T_MESSAGE, [self.__username], message)
-                c.disconnect()
+                c = self.__sendToPeer(uIp, uP, p.T_MESSAGE, [self.__username], message)
+                self.__peers.release(uIp, uP, c)
 
             else:
                 raise Exception, 'User %s can\'t be reached.' % username
@@ -95,9 +272,7 @@ class ChatClient:
             if (username in self.__userList):
    
                 uIp, uP = self.__userList[username]
-                c = ConnectionManager(uIp, uP)
-                c.connect()
-                c.send(p.T_MESSAGE, [self.__username], message)
+                c = self.__sendToPeer(uIp, uP, p.T_MESSAGE, [self.__username], message)
                 
                 # We wait for four replies from GLADOS to receive the final token
                 # The application is going to block until GLADOS replies.
@@ -106,10 +281,13 @@ class ChatClient:
                 # in raw format just to get the final token. 
                 for i in range(0,3):
                     r = c.receive()
+                    if r is None:
+                        self.__peers.discard(uIp, uP, c)
+                        raise Exception, 'No reply from %s' % username
                     self.__agent.printMessage(str(r),'Bot user')
                     if(r.type == p.T_PING):
                         c.send(p.T_PONG, [self.__username])
-                c.disconnect()
+                self.__peers.release(uIp, uP, c)
             else:
                 raise Exception, 'User %s can\'t be reached.' % username
 
@@ -126,57 +304,143 @@ class ChatClient:
             if (username in self.__userList):
    
                 uIp, uP = self.__userList[username]
-                c = ConnectionManager(uIp, uP)
-
-                c.connect()
-                c.send(p.T_PING, [self.__username])
+                c = self.__sendToPeer(uIp, uP, p.T_PING, [self.__username])
 
                 pong = c.receive()
+                if pong is None:
+                    self.__peers.discard(uIp, uP, c)
+                    raise Exception, 'No reply from %s' % username
+                self.__peers.release(uIp, uP, c)
                 self.__agent.printMessage(pong.type, pong.args.pop())
-
-                c.disconnect()
             else:
                 raise Exception, 'User %s can\'t be pinged.' % username
 
         except Exception,e:
             self.__handleError('Ping', e)
 
+    def peerStats(self):
+        """ Show the connection statistics of every user contacted so far """
+
+        for (uIp, uP), stats, isOpen in self.__peers.statistics():
+            self.__agent.printMessage("%s:%d %s%s" % (uIp, uP, stats, ", open" if isOpen else ""), "Peers")
+
     def getUsername(self):
         return self.__username
 
+    def __sendToPeer(self, uIp, uP, msgType, msgArgs, msgPayload = ""):
+        """ Send a message on a pooled connection to another user. The connection is
+            returned, and must be given back to the pool with release() or discard().
+            If a reused connection turns out to be broken, a new one is opened. """
+
+        for attempt in range(2):
+            c = self.__peers.acquire(uIp, uP)
+            if c.send(msgType, msgArgs, msgPayload):
+                return c
+            self.__peers.discard(uIp, uP, c)
+
+        raise Exception, 'Unable to send to %s:%d' % (uIp, uP)
+
     def __unregister(self, args = []):
         """ Unregisterer from directory server and close all connections """
 
         try:
-            self.__cm.send(p.T_LEAVE,[])
-            reply = self.__cm.receive()
-            if (reply.type != p.T_ACK):
+            self.__subscribed = False
+            self.__bindPort = None
+            self.__sessionToken = None
+            if self.__renewTimer is not None:
+                self.__renewTimer.cancel()
+            reply = self.__request(p.T_LEAVE,[])
+            if (reply is None or reply.type != p.T_ACK):
                 raise Exception, "Unregistering from server was not successfull. Disconnecting anyway!"
         
         except Exception,e:
             self.__handleError('Leave', e)
 
-    def __login(self, args = []):
-        """ Authenticate with the remote server and register afterwards. """
+        if self.__session is not None:
+            self.__session.close()
 
-        try:
-             
-            # Send username and wait for an ACK
-            self.__cm.send(p.T_USER, [self.__username])
-            reply = self.__cm.receive()
-            
-            if (reply.type != p.T_ACK):
-                raise Exception, "Unable to login!"
+    def __authenticateOn(self, cm):
+        """ Run the USER / PASS exchange on a connection, raising on failure """
 
-            # Send password and wait for an ACK
-            self.__cm.send(p.T_PASS, [self.__password])
-            reply = self.__cm.receive()
-            
-            if (reply.type != p.T_ACK):
-                raise Exception, "Invalid credentials!"
+        # Send username and password together, then wait for the two ACKs
+        cm.send(p.T_USER, [self.__username], flush = False)
+        cm.send(p.T_PASS, [self.__password])
+        reply = cm.receive()
+        
+        if (reply is None or reply.type != p.T_ACK):
+            raise Exception, "Unable to login!"
+
+        reply = cm.receive()
+        
+        if (reply is None or reply.type != p.T_ACK):
+            raise Exception, "Invalid credentials!"
+
+    def __resumeOn(self, cm):
+        """ Try to restore the login and the binding with the session token. Returns
+            False if the directory refused it, the USER / PASS exchange can follow
+            on the same connection. """
+
+        if self.__sessionToken is None:
+            return False
+
+        cm.send(p.T_RESUME, [self.__username, self.__sessionToken])
+        reply = cm.receive()
+
+        if reply is None:
+            raise Exception, "Unable to login!"
+        if reply.type != p.T_ACK:
+            self.__sessionToken = None
+            return False
+
+        self.__keepBinding(reply)
+        return True
+
+    def __keepBinding(self, reply):
+        """ Keep the lease and the token sent along with the ACK of a BIND, a RESUME
+            or a RENEW """
+
+        for arg in reply.args:
+            if arg.isdigit():
+                # The binding is a lease, renew it halfway through
+                self.__scheduleRenew(int(arg) / 2.0)
+            elif arg.startswith("session="):
+                self.__sessionToken = arg[len("session="):]
+
+    def __scheduleRenew(self, delay):
+        """ Send a RENEW after delay seconds """
+
+        if self.__renewTimer is not None:
+            self.__renewTimer.cancel()
+        self.__renewTimer = threading.Timer(delay, self.__renew)
+        self.__renewTimer.daemon = True
+        self.__renewTimer.start()
+
+    def __renew(self):
+        """ Renew the lease before the directory drops us. A session that dropped
+            is opened again first, and resuming it renews the lease too. """
+
+        if self.__bindPort is None:
+            return
+
+        try:
+            reply = self.__request(p.T_RENEW)
+            if (reply is None or reply.type != p.T_ACK):
+                raise Exception, "The directory did not renew the binding"
+            self.__keepBinding(reply)
 
         except Exception,e:
-            self.__handleError('Authenticate', e)
+            self.__handleError('Renew', e)
+            self.__scheduleRenew(self.RENEW_RETRY)
+
+    def __notified(self, msg):
+        """ Apply the changes pushed by the directory """
+
+        if len(msg.args) == 2:
+            self.__syncToken, mode = msg.args
+            if mode == 'full':
+                self.__userList.clear()
+            [ self.__applyUserChange(r) for r in msg.payload.split() ]
+            self.__agent.printList(self.__userList)
     
     def __bind(self, args = []):
         """ Start local server and bind to the port updating the server accordingly """
@@ -188,15 +452,16 @@ class ChatClient:
 
             # Sleep a little bit to allow the new thread to open the listening port
             sleep(0.3)
-            
-            serverIp, serverPort = self.__cm.getConnectionInfo()
 
-            self.__cm.send(p.T_BIND, [serverIp, localServerPort])
-            reply = self.__cm.receive()
+            reply = self.__request(p.T_BIND, [self.__host, localServerPort])
             
-            if (reply.type == p.T_ERR):
+            if (reply is None or reply.type == p.T_ERR):
                 raise Exception, "Port binding was not succussful!"
 
+            # Bind again to the same port if the session has to be opened again
+            self.__bindPort = localServerPort
+            self.__keepBinding(reply)
+
         except Exception,e:
             self.__handleError('Bind', e)
 
@@ -204,12 +469,7 @@ class ChatClient:
         """ Search for username is the server's database """
 
         try:
-            if len(args) == 0:
-                self.__cm.send(p.T_QUERY, '')
-            else:
-                self.__cm.send(p.T_QUERY, args)
-
-            reply = self.__cm.receive()
+            reply = self.__request(p.T_QUERY, args)
 
             if (reply is not None and reply.type == p.T_RESULT):
                 [ self.__parseUserRecord(r) for r in reply.payload.split() ] 
@@ -220,6 +480,57 @@ class ChatClient:
         except Exception, e:
             self.__handleError('List', e) 
 
+    def __syncUsers(self, args = []):
+        """ Bring the user list up to date. Once we hold a version token, 
+            the directory only sends the users that joined or left since then. """
+
+        try:
+            reply = self.__request(p.T_SYNC, [self.__syncToken] if self.__syncToken else [])
+
+            if (reply is not None and reply.type == p.T_RESULT and len(reply.args) == 2):
+                self.__syncToken, mode = reply.args
+                if mode == 'full':
+                    self.__userList.clear()
+                [ self.__applyUserChange(r) for r in reply.payload.split() ]
+                self.__agent.printList(self.__userList)
+            else:
+                raise Exception, "An error occured while fetching user data! The user list is outdated."
+
+        except Exception, e:
+            self.__handleError('List', e)
+
+    def __browseUsers(self, args = []):
+        """ Fetch one page of users, the directory returns the cursor of the next one """
+
+        try:
+            query = ["prefix=%s" % self.__browsePrefix, "limit=%d" % self.PAGE_SIZE]
+            if self.__browseCursor is not None:
+                query.append("after=%s" % self.__browseCursor)
+            reply = self.__request(p.T_QUERY, query)
+
+            if (reply is not None and reply.type == p.T_RESULT and len(reply.args) == 1):
+                self.__browseCursor = reply.args[0][len("next="):] or None
+                page = {}
+                for r in reply.payload.split():
+                    self.__parseUserRecord(r)
+                    username = r.split(',')[0]
+                    page[username] = self.__userList[username]
+                self.__agent.printList(sorted(page))
+            else:
+                raise Exception, "An error occured while fetching user data!"
+
+        except Exception, e:
+            self.__handleError('Find', e)
+
+    def __applyUserChange(self, record):
+        """ Apply one line of a SYNC result: '-username' for a user that left,
+            a user record, optionally prefixed by '+', otherwise """
+
+        if record.startswith('-'):
+            self.__userList.pop(record[1:], None)
+        else:
+            self.__parseUserRecord(record.lstrip('+'))
+
     def __parseUserRecord(self, record):
         """ Parse user records and store the extracted information in a tuple in a dictionary """
 
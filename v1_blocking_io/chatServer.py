@@ -13,14 +13,35 @@ import sys
 import parsing as p
 import threading
 import socket
+import select
+import errno
+import Queue
+import time
 
 from parsing import Message
 from connectionManager import ConnectionManager
 
 
 
+class PeerConnection:
+    """ State of one inbound connection """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = p.StreamDecoder()    # Keeps the frames split across reads
+        self.outbuf = ''        # Replies not written yet
+        self.writing = False    # Waiting for the socket to become writable
+
+
 class ChatServer(threading.Thread):
-    """ Chat Server class initializes a daemon for each incoming request. """
+    """ Chat Server class receives the messages of the other users. One thread serves
+        every inbound connection, waiting for the ready ones with epoll (or poll where
+        it is not available), so a slow or idle peer never holds up the others. The
+        decoded messages are handed to the agent by a second thread, through a queue.
+        When accept fails, e.g. out of file descriptors, the listener is left out of
+        the poller for ACCEPT_PAUSE seconds rather than polled again at once. """
+
+    ACCEPT_PAUSE = 1
 
     def __init__(self, host, username, agent):
         threading.Thread.__init__(self)
@@ -28,6 +49,17 @@ class ChatServer(threading.Thread):
         self.__agent = agent
         self.__username = username
         self.__sock = ConnectionManager.createListeningSocket(host)
+        self.__connections = {}         # File descriptor -> PeerConnection
+        self.__inbox = Queue.Queue()    # (payload, sender) of the messages to show
+        self.__acceptPaused = None      # Time at which accepting resumes, during a pause
+        self.__acceptFailing = False    # The last accept failed, and was reported
+
+        if hasattr(select, 'epoll'):
+            self.__poller = select.epoll()
+            self.__pollUnit = 1.0       # epoll timeouts are in seconds
+        else:
+            self.__poller = select.poll()
+            self.__pollUnit = 1000.0    # poll timeouts in milliseconds
 
     def getServerPort(self):
         return self.__sock.getsockname()[1]
@@ -36,33 +68,130 @@ class ChatServer(threading.Thread):
 
         try:
 
-            # Listen to maximum 5 queued connections. We use the queue here to avoid 
-            # invoking a new thread for each incoming message
-            self.__sock.listen(5)
+            self.__sock.listen(socket.SOMAXCONN)
+            self.__sock.setblocking(0)
+            listener = self.__sock.fileno()
+            self.__poller.register(listener, select.POLLIN)
+
+            deliverer = threading.Thread(target = self.__deliver)
+            deliverer.daemon = True
+            deliverer.start()
+
             while True:
-               self.conn, self.addr = self.__sock.accept()
-               while True:
-                   data = self.conn.recv(1024)
-                   if not data:
-                        break
-
-                   message = self.parseMsg(data)
-
-                   if len(message) > 0:
-                       if message[0].type == p.T_PING:
-                           pong = Message("PONG", [self.__username])
-                           self.conn.send(str(pong))
-                       elif message[0].type == p.T_MESSAGE:
-                           self.__agent.printMessage(message[0].payload,message[0].args.pop())
+                timeout = -1
+                if self.__acceptPaused is not None:
+                    timeout = max(0, self.__acceptPaused - time.time()) * self.__pollUnit
+                try:
+                    events = self.__poller.poll(timeout)
+                except (IOError, select.error), e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                if self.__acceptPaused is not None and time.time() >= self.__acceptPaused:
+                    self.__acceptPaused = None
+                    self.__poller.register(listener, select.POLLIN)
+
+                for fd, event in events:
+                    if fd == listener:
+                        self.__accept()
+                    else:
+                        self.__serve(fd, event)
         
         except Exception ,e:
             self.__handleError(str(e))
 
-        finally:
-            self.conn.close()
+    def __accept(self):
+        """ Accept all the pending connections """
+
+        while True:
+            try:
+                conn, addr = self.__sock.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if e.args[0] in (errno.ECONNABORTED, errno.EINTR):
+                    continue
+                # The listener stays readable: stop polling it for a while,
+                # and report the error once until an accept succeeds
+                if not self.__acceptFailing:
+                    self.__handleError(str(e))
+                    self.__acceptFailing = True
+                self.__poller.unregister(self.__sock.fileno())
+                self.__acceptPaused = time.time() + ChatServer.ACCEPT_PAUSE
+                return
+
+            self.__acceptFailing = False
+            conn.setblocking(0)
+            self.__connections[conn.fileno()] = PeerConnection(conn)
+            self.__poller.register(conn.fileno(), select.POLLIN)
+
+    def __serve(self, fd, event):
+        """ Read and decode what a peer sent, or write the pending replies """
+
+        peer = self.__connections.get(fd)
+        if peer is None:
+            return
+
+        try:
+            if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                try:
+                    data = peer.sock.recv(4096)
+                except socket.error, e:
+                    if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    data = None
+
+                if data == '':
+                    # The other user closed the connection
+                    return self.__close(fd)
+
+                if data:
+                    # Every complete frame is handled, however the data was split
+                    [ self.__handle(peer, m) for m in peer.decoder.feed(data) ]
+
+            if peer.outbuf:
+                self.__flush(fd, peer)
+
+        except Exception, e:
+            self.__handleError(str(e))
+            self.__close(fd)
+
+    def __handle(self, peer, message):
+        if message.type == p.T_PING:
+            peer.outbuf += str(Message("PONG", [self.__username]))
+        elif message.type == p.T_MESSAGE:
+            self.__inbox.put((message.payload, message.args[-1] if message.args else ''))
+
+    def __flush(self, fd, peer):
+        try:
+            sent = peer.sock.send(peer.outbuf)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            sent = 0
+        peer.outbuf = peer.outbuf[sent:]
+
+        # Wait for the socket to become writable only while there is something to write
+        if peer.outbuf and not peer.writing:
+            peer.writing = True
+            self.__poller.modify(fd, select.POLLIN | select.POLLOUT)
+        elif not peer.outbuf and peer.writing:
+            peer.writing = False
+            self.__poller.modify(fd, select.POLLIN)
+
+    def __close(self, fd):
+        peer = self.__connections.pop(fd, None)
+        if peer is not None:
+            self.__poller.unregister(fd)
+            peer.sock.close()
+
+    def __deliver(self):
+        """ Body of the thread showing the received messages """
 
-    def parseMsg(self, msg):
-        return filter(None, list(p.parse(msg)))
+        while True:
+            payload, sender = self.__inbox.get()
+            self.__agent.printMessage(payload, sender)
 
     def __handleError(self, msg):
         self.__agent.printMessage(str(msg), "Server Error")
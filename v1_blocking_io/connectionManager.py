@@ -14,12 +14,15 @@ import sys
 import parsing as p
 
 from threading import Timer
+from collections import deque
 
 
 
 class ConnectionManager:
     """ Simple Socket Connection Manager with blocking IO. """
 
+    TIMEOUT = 10                        # Seconds to connect, and to wait for data
+
     def __init__(self, host, port, sock = None):
         if sock is None:
             self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -27,14 +30,31 @@ class ConnectionManager:
         else:
             self.__sock = sock
         
-        self.__sock.settimeout(10)
+        self.__sock.settimeout(self.TIMEOUT)
+        # Writes are coalesced in __outgoing, so Nagle would only add delays
+        self.__sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.__host = host
         self.__port = port
-        self.__buffer = ''
+        self.__decoder = p.StreamDecoder()
+        self.__messages = deque()           # Messages decoded but not returned yet
+        self.__closed = False
+        self.__outgoing = []                # Buffers of the messages not flushed yet
+
+        # Counters of the outgoing traffic
+        self.messagesSent = 0
+        self.bytesSent = 0
+        self.sendCalls = 0
 
     def getConnectionInfo(self):
         return self.__host, self.__port
 
+    def fileno(self):
+        return self.__sock.fileno()
+
+    def isClosed(self):
+        """ True once the other end closed the connection, as opposed to a receive timeout """
+        return self.__closed
+
     def connect(self):
         """ Connect to specific socket """
         
@@ -52,17 +72,41 @@ class ConnectionManager:
         if sent > 0 and echo:
             print "Sent: %s"%msg,
 
-    def send(self, msgType, msgArgs = [], msgPayload = ""):
-        """ Send a message over socket """
+    def send(self, msgType, msgArgs = [], msgPayload = "", flush = True):
+        """ Send a message over socket. With flush set to False the message is
+            only queued, to go out with the next one in a single write. """
 
         m = p.Message(msgType, msgArgs, msgPayload)
+        self.__outgoing.extend(m.encode())
+        self.messagesSent += 1
+
+        if flush:
+            return self.flush()
+        return True
+
+    def flush(self):
+        """ Write the queued messages """
+
+        chunks = p.gather(self.__outgoing)
+        self.__outgoing = []
 
         try:
-            self.__sock.sendall(str(m))
+            for chunk in chunks:
+                while chunk:
+                    sent = self.__sock.send(chunk)
+                    self.sendCalls += 1
+                    self.bytesSent += sent
+                    chunk = buffer(chunk, sent) if sent < len(chunk) else None
             return True
         except Exception,e:
             print 'Something went wrong while sending your message :(', e
 
+    def sendStats(self):
+        """ Bytes and send calls per message, to check how writes are coalesced """
+
+        messages = float(max(self.messagesSent, 1))
+        return self.bytesSent / messages, self.sendCalls / messages
+
     def receiveRaw(self, echo = False):
         """ Receive raw data """
 
@@ -86,24 +130,33 @@ class ConnectionManager:
     def receive(self, echo = False):
         """ Receive messages """
 
-        msg=None
-        
-        while msg == None:
+        while not self.__messages:
             try:
                 pay = self.__sock.recv(1024)
-                self.__buffer+=pay
                 
                 if not pay:
+                    self.__closed = True
                     break
 
+            except socket.timeout:
+                break
+
             except socket.error,e:
+                self.__closed = True
                 break
             
-            self.__buffer, msg = p.parse(self.__buffer)
+            self.__messages.extend(self.__decoder.feed(pay))
 
-        return msg
+        return self.__messages.popleft() if self.__messages else None
 
     def disconnect(self):
+        """ Close the connection. A thread blocked receiving on it returns at once. """
+
+        self.__closed = True
+        try:
+            self.__sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
         self.__sock.close()
 
     @staticmethod
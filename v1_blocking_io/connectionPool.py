@@ -0,0 +1,134 @@
+#
+# connectionPool.py
+#
+# @author       : Vidros Sokratis <vidros@eurecom.fr>
+# @date         : 9-1-2012
+# @copyright    : Copyright (c) 2012 Vidros Sokratis
+# @license      : http://creativecommons.org/licenses/by-nd-nc/1.0/
+# @version      : 1.0
+# @description  : Pool of open connections to the other peers
+#
+
+import time
+import select
+import socket
+import threading
+
+from collections import OrderedDict
+from connectionManager import ConnectionManager
+
+
+
+class PeerStats:
+    """ Counters of the traffic towards one peer """
+
+    def __init__(self):
+        self.connects = 0       # Connections opened
+        self.reuses = 0         # Exchanges served by an already open connection
+        self.drops = 0          # Pooled connections found closed, stale or broken
+        self.evictions = 0      # Connections closed to make room for other peers
+
+    def __str__(self):
+        return "%d connects, %d reuses, %d drops, %d evictions" % (self.connects, self.reuses, self.drops, self.evictions)
+
+
+class ConnectionPool:
+    """ Bounded pool of open connections to other peers, keyed by (ip, port).
+        A connection is taken with acquire() for one exchange, and given back
+        with release() once it is over, or with discard() if it failed. Idle
+        connections are closed after IDLE_TIMEOUT seconds, and the least recently
+        used one is closed when the pool is full. """
+
+    MAX_CONNECTIONS = 16
+    IDLE_TIMEOUT = 60
+
+    def __init__(self, maxConnections = MAX_CONNECTIONS, idleTimeout = IDLE_TIMEOUT):
+        self.__maxConnections = maxConnections
+        self.__idleTimeout = idleTimeout
+        self.__connections = OrderedDict()  # (ip, port) -> (connection, last use), least recently used first
+        self.__stats = {}                   # (ip, port) -> PeerStats
+        self.__lock = threading.Lock()
+
+    def acquire(self, ip, port):
+        """ Return an open connection to the peer, reusing the pooled one if it is
+            still healthy. Raises socket.error if the peer can't be reached. """
+
+        key = (ip, port)
+        with self.__lock:
+            entry = self.__connections.pop(key, None)
+            stats = self.__stats.setdefault(key, PeerStats())
+
+        if entry is not None:
+            cm, lastUse = entry
+            if time.time() - lastUse < self.__idleTimeout and self.__healthy(cm):
+                stats.reuses += 1
+                return cm
+            stats.drops += 1
+            cm.disconnect()
+
+        cm = ConnectionManager(ip, port, socket.create_connection(key, ConnectionManager.TIMEOUT))
+        stats.connects += 1
+        return cm
+
+    def release(self, ip, port, cm):
+        """ Put back a connection after a successful exchange """
+
+        if cm.isClosed():
+            return
+
+        closing = []
+        with self.__lock:
+            previous = self.__connections.pop((ip, port), None)
+            if previous is not None:
+                closing.append(previous[0])
+            self.__connections[(ip, port)] = (cm, time.time())
+
+            closing += self.__expire()
+            while len(self.__connections) > self.__maxConnections:
+                key, (lru, lastUse) = self.__connections.popitem(last = False)
+                self.__stats[key].evictions += 1
+                closing.append(lru)
+
+        [ c.disconnect() for c in closing ]
+
+    def discard(self, ip, port, cm):
+        """ Close a connection on which an exchange failed """
+
+        with self.__lock:
+            self.__stats.setdefault((ip, port), PeerStats()).drops += 1
+        cm.disconnect()
+
+    def closeAll(self):
+        with self.__lock:
+            closing = [ cm for cm, lastUse in self.__connections.values() ]
+            self.__connections.clear()
+        [ c.disconnect() for c in closing ]
+
+    def statistics(self):
+        """ Return a list of ((ip, port), PeerStats, open) for every peer contacted so far """
+
+        with self.__lock:
+            return [ (key, stats, key in self.__connections) for key, stats in sorted(self.__stats.items()) ]
+
+    def __expire(self):
+        """ Remove the connections idle for too long, to be closed by the caller """
+
+        expired = []
+        deadline = time.time() - self.__idleTimeout
+        while self.__connections:
+            key, (cm, lastUse) = next(self.__connections.iteritems())
+            if lastUse >= deadline:
+                break
+            del self.__connections[key]
+            expired.append(cm)
+        return expired
+
+    def __healthy(self, cm):
+        """ An idle connection must have nothing to read: otherwise the peer closed
+            it, or sent something that would be taken for the reply to our request """
+
+        try:
+            readable, writable, failed = select.select([cm.fileno()], [], [], 0)
+            return not readable
+        except (select.error, socket.error):
+            return False
@@ -38,6 +38,7 @@ class Agent(protocol.Protocol):
         self.transport.write("User %s, connected at %s\n" %(self.__cClient.username, self.__cClient.host)) 
         self.transport.write("\nType help to see all the available commands.\n")
         self.transport.write(self.prompt)
+        self.__cClient.addRestoredCallback(self.printMessage, "Session with the directory restored", "info")
         
     def connectionLost(self, reason):
         self.quit()
@@ -65,8 +66,18 @@ class Agent(protocol.Protocol):
                 match = re.search('^list ([a-zA-Z0-9]+)$', input)
                 if (match):
                     self.__result = self.__cClient.search(match.group(1))
+                    self.__result.addCallbacks(self.__showUser, self.__showError, callbackArgs = (match.group(1),))
                 else:
                     self.__result = self.__cClient.listAll()
+                    self.__result.addCallbacks(self.__showList, self.__showError)
+            elif (input.find('find') == 0):
+                match = re.search('^find ?([a-zA-Z0-9]*)$', input)
+                if (match):
+                    self.__result = self.__cClient.browse(match.group(1))
+                    self.__result.addCallbacks(self.__showPage, self.__showError)
+            elif re.search("^more$", input):
+                self.__result = self.__cClient.browseMore()
+                self.__result.addCallbacks(self.__showPage, self.__showError)
             elif (input.find('ping') == 0):
                 match = re.search('^ping ([a-zA-Z0-9]+)$', input)
                 if (match):
@@ -76,11 +87,16 @@ class Agent(protocol.Protocol):
                 username = match.group(1)
                 message = match.group(2)
                 self.__cClient.getSecret(username, message)
+            elif re.search("^status$", input):
+                self.printMessage(str(self.__cClient.reconnect), "status")
             elif re.search("^help$", input):
                 self.printMessage("Available commands:", "help")
                 self.printMessage("chat user message    : Chat with another user.", "help")
                 self.printMessage("list                 : List all online users.", "help")
+                self.printMessage("find prefix          : List the online users starting with prefix.", "help")
+                self.printMessage("more                 : Next page of the last find.", "help")
                 self.printMessage("ping user            : Ping user.", "help")
+                self.printMessage("status               : Reconnections to the directory.", "help")
                 self.printMessage("bye                  : I think its obvious ;)", "help")
             else:
                 raise Exception, "Invalid command " + input + ", type help to list all the available commands."
@@ -97,6 +113,25 @@ class Agent(protocol.Protocol):
 
     def printList(self, msg):
         self.transport.write(msg)
+
+    def __showList(self, userList):
+        self.printList("Online users:\n")
+        for x in userList:
+            self.printMessage("%s, %s" % (x, userList[x]), "list")
+
+    def __showUser(self, address, username):
+        if address is None:
+            self.printMessage("%s is not online" % username, "list")
+        else:
+            self.printMessage("%s, %s" % (username, address), "list")
+
+    def __showPage(self, users):
+        self.printList("Found users:\n")
+        for username, address in users:
+            self.printMessage("%s, %s" % (username, address), "find")
+
+    def __showError(self, failure):
+        self.printMessage(failure.getErrorMessage(), "error")
         
     def quit(self):
         reactor.stop()
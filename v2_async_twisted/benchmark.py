@@ -0,0 +1,191 @@
+#
+# benchmark.py
+#
+# @author       : Vidros Sokratis <vidros@eurecom.fr>
+# @date         : 20-1-2012
+# @copyright    : Copyright (c) 2012 Vidros Sokratis
+# @license      : http://creativecommons.org/licenses/by-nd-nc/1.0/
+# @version      : 1.0
+# @description  : Benchmark of the dispatch of received messages
+#
+
+import sys
+import time
+import parsing as p
+
+from twisted.internet import reactor, defer
+
+from chatServer import MessageProtocol
+from chatClient import ReconnectPolicy
+
+
+
+class CountingProtocol(MessageProtocol):
+    """ Counts the messages handled, checking that they come in the order they
+        were sent. One message out of failEvery raises once it is counted. """
+
+    def __init__(self, expected, failEvery = 0):
+        self.decoder = p.StreamDecoder()
+        self.expected = expected
+        self.failEvery = failEvery
+        self.received = 0
+        self.failed = 0
+        self.inOrder = True
+        self.done = defer.Deferred()
+
+    def msgReceived(self, msg):
+        # The payload of every message is its sequence number
+        self.inOrder = self.inOrder and int(msg.payload) == self.received
+        self.received += 1
+        failing = self.failEvery and self.received % self.failEvery == 0
+        if failing:
+            self.failed += 1
+        if self.received == self.expected:
+            self.done.callback(self)
+
+        if failing:
+            raise ValueError("failing message %d on purpose" % (self.received - 1))
+
+
+class ScheduledProtocol(CountingProtocol):
+    """ Reference implementation of the previous dispatch path, which schedules
+        a separate call through the reactor for every decoded message """
+
+    def dataReceived(self, data):
+        for msg in self.decoder.feed(data):
+            reactor.callLater(0, self.msgReceived, msg)
+
+
+def benchDispatch(cls, frames, chunk, failEvery):
+    """ Feed one protocol a burst of MESSAGE frames, one chunk per reactor
+        iteration as a transport would. Returns a Deferred fired with the
+        protocol and the number of messages handled per second, once all
+        the frames have been handled. """
+
+    proto = cls(frames, failEvery)
+    data = "".join([ str(p.Message(p.T_MESSAGE, ["bench"], str(i))) for i in xrange(frames) ])
+
+    def feed(pos):
+        proto.dataReceived(data[pos:pos + chunk])
+        if pos + chunk < len(data):
+            reactor.callLater(0, feed, pos + chunk)
+
+    def finished(proto):
+        return proto, frames / (time.time() - started)
+
+    started = time.time()
+    reactor.callLater(0, feed, 0)
+    return proto.done.addCallback(finished)
+
+
+def dispatchSuite(values):
+    """ Returns a Deferred fired with True if every message was handled in order
+        on both dispatch paths """
+
+    print "Dispatch of %d MESSAGE frames read %d bytes at a time, %s" % (values.frames, values.chunk,
+        "one handler out of %d failing" % values.fail_every if values.fail_every else "no handler failing")
+
+    results = []
+
+    def report((proto, rate), name):
+        print "%-10s %12.0f msgs/s %8d handled %6d failed %s" % (
+            name, rate, proto.received, proto.failed, "in order" if proto.inOrder else "OUT OF ORDER")
+        results.append((name, rate, proto.received == proto.expected and proto.inOrder))
+
+    def compare(ignored):
+        if len(results) == 2:
+            print "batched dispatch is x%.2f the callLater one" % (results[1][1] / results[0][1])
+        return all([ ok for name, rate, ok in results ])
+
+    d = defer.succeed(None)
+    for name, cls in (("callLater", ScheduledProtocol), ("batched", CountingProtocol)):
+        d.addCallback(lambda ignored, cls = cls: benchDispatch(cls, values.frames, values.chunk, values.fail_every))
+        d.addCallback(report, name)
+    return d.addCallback(compare)
+
+
+def simulateBounce(clients, downtime, policy):
+    """ Replay the reconnections of clients dropped together by a directory that
+        comes back after downtime seconds. policy(client) returns the delay before
+        the next attempt of a client, or None if it gives up. Returns the time every
+        client connected back at, None for those that gave up, and the number of
+        attempts. """
+
+    connected = []
+    attempts = 0
+    for n in range(clients):
+        retry = policy(n)
+        t = 0.0
+        while True:
+            delay = retry()
+            if delay is None:
+                connected.append(None)
+                break
+            t += delay
+            attempts += 1
+            if t >= downtime:
+                connected.append(t)
+                break
+    return connected, attempts
+
+
+def reconnectSuite(values):
+    """ Returns True if the backoff brings every client back without the peak of
+        the immediate reconnection """
+
+    print "%d clients dropped by a directory down for %.1fs, arrivals counted per %dms" % (
+        values.clients, values.downtime, values.window * 1000)
+
+    def immediate(n):
+        # Previous behaviour: one attempt right away, then nothing since the
+        # failure of a directory connection was only reported
+        tries = [ 0.0 ]
+        return lambda: tries.pop() if tries else None
+
+    def backoff(n):
+        return ReconnectPolicy().nextDelay
+
+    peaks = []
+    for name, policy in (("immediate", immediate), ("backoff", backoff)):
+        connected, attempts = simulateBounce(values.clients, values.downtime, policy)
+        back = sorted([ t for t in connected if t is not None ])
+        windows = {}
+        for t in back:
+            windows[int(t / values.window)] = windows.get(int(t / values.window), 0) + 1
+        peak = max(windows.values()) if windows else 0
+        peaks.append((len(back), peak))
+        quantile = lambda q: back[int(q * (len(back) - 1))] if back else 0
+        print "%-10s %6d back %6d attempts %6d peak per window, half back at %.1fs, 99%% at %.1fs, all at %.1fs" % (
+            name, len(back), attempts, peak, quantile(0.5), quantile(0.99), quantile(1))
+
+    (immediateBack, immediatePeak), (backoffBack, backoffPeak) = peaks
+    return backoffBack == values.clients and backoffPeak < values.clients
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    op = OptionParser()
+    op.add_option("-f", "--frames", dest = "frames", type = "int", default = 100000, help = "Frames in the burst")
+    op.add_option("-c", "--chunk", dest = "chunk", type = "int", default = 65536, help = "Bytes handed to the protocol at each read")
+    op.add_option("-e", "--fail-every", dest = "fail_every", type = "int", default = 1000, help = "One handler out of this many raises, 0 for none")
+    op.add_option("-n", "--clients", dest = "clients", type = "int", default = 10000, help = "Clients dropped by the directory bounce")
+    op.add_option("-D", "--downtime", dest = "downtime", type = "float", default = 5.0, help = "Seconds the directory stays down")
+    op.add_option("-w", "--window", dest = "window", type = "float", default = 0.1, help = "Seconds over which arrivals are counted")
+    op.add_option("-s", "--suite", dest = "suite", type = "choice", choices = ["all", "dispatch", "reconnect"], default = "all", help = "Benchmark to run")
+
+    (values, args) = op.parse_args()
+
+    outcome = [ True ]
+    if values.suite in ("all", "reconnect"):
+        outcome.append(reconnectSuite(values))
+
+    if values.suite in ("all", "dispatch"):
+        def stop(ok):
+            outcome.append(ok is True)
+            reactor.stop()
+
+        reactor.callWhenRunning(lambda: dispatchSuite(values).addBoth(stop))
+        reactor.run()
+
+    sys.exit(0 if all(outcome) else 1)
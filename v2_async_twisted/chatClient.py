@@ -10,14 +10,18 @@
 # 
 
 import re
+import time
+import random
 import parsing as p
 
-from twisted.internet import reactor,protocol
+from collections import OrderedDict, deque
+from twisted.internet import reactor,protocol,task,defer
 from twisted.internet.protocol import ClientFactory
 
-from chatServer import PeerProtocol
+from chatServer import MessageProtocol,PeerProtocol
 
 
+S_RESUMESENT    = "RESUME_SENT"
 S_LOGINSENT     = "LOGIN_SENT"
 S_PASSSENT      = "PASS_SENT"
 S_AUTHENTICATED = "AUTHENTICATED"
@@ -25,40 +29,143 @@ S_ERROR         = "ERROR"
 
 
 
-class DirectoryProtocol(protocol.Protocol):
-    """ Implementing Eurechat server protocol between user and directory server. """
+class DirectoryError(Exception):
+    """ The directory refused a request, or could not answer it """
+
+
+
+class ReconnectPolicy:
+    """ Capped exponential backoff with full jitter for the reconnections to the
+        directory. The n-th attempt in a row waits a random time between 0 and
+        min(MAX_DELAY, INITIAL_DELAY * FACTOR ** n), so that the clients dropped
+        together by a directory restart come back spread over time, and a
+        directory that keeps failing is retried less and less often. """
+
+    INITIAL_DELAY = 1.0
+    MAX_DELAY = 60.0
+    FACTOR = 2.0
+
+    def __init__(self, initialDelay = INITIAL_DELAY, maxDelay = MAX_DELAY, factor = FACTOR):
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.factor = factor
+        self.retries = 0        # Attempts since the last session was established
+        self.attempts = 0       # Reconnections attempted
+        self.sessions = 0       # Sessions established
+        self.restored = 0       # Sessions established again after a reconnection
+        self.lastDelay = None
+
+    def nextDelay(self):
+        """ Seconds to wait before the next attempt """
+
+        ceiling = min(self.maxDelay, self.initialDelay * self.factor ** self.retries)
+        self.retries += 1
+        self.attempts += 1
+        self.lastDelay = random.uniform(0, ceiling)
+        return self.lastDelay
+
+    def established(self):
+        """ A session was established, start over with short delays.
+            Returns True if it replaces a lost one. """
+
+        restored = self.sessions > 0
+        self.sessions += 1
+        if restored:
+            self.restored += 1
+        self.retries = 0
+        return restored
+
+    def __str__(self):
+        return "%d reconnection attempts, %d sessions restored, %d attempts since the last one" % (
+            self.attempts, self.restored, self.retries)
+
+
+
+class PendingRequest:
+    """ A request sent to the directory and not answered yet """
+
+    def __init__(self, msgType):
+        self.msgType = msgType
+        self.deferred = defer.Deferred()
+        self.timeoutCall = None
+
+
+
+class DirectoryProtocol(MessageProtocol):
+    """ Implementing Eurechat server protocol between user and directory server.
+        Once logged in, the directory answers every request with one ACK, RESULT
+        or ERR, in the order the requests were sent. The requests in flight are
+        kept in the same order, so every answer goes to the oldest one. The
+        directory closes the sessions idle for 30 seconds, so a PING is sent
+        every KEEPALIVE_INTERVAL seconds once logged in. """
+
+    REQUEST_TIMEOUT = 10            # Seconds to wait for the answer to a request
+    KEEPALIVE_INTERVAL = 10         # Seconds between two PINGs to the directory
     
     def connectionMade(self):
         self.factory.connection=self
-        self.def_list=[]
-        self.buffer = ""
-        self.msgSend(p.T_USER, [self.factory.username])
-        self.state = S_LOGINSENT
+        self.transport.setTcpNoDelay(True)
+        self.pending = deque()          # PendingRequest, oldest first
+        self.decoder = p.StreamDecoder()
+        self.renewCall = None
+        self.keepalive = task.LoopingCall(self.__keepalive)
+        self.keepalive.start(self.KEEPALIVE_INTERVAL, now = False)
+        if self.factory.sessionToken:
+            # Bound before, log in and bind again in one round trip
+            self.msgSend(p.T_RESUME, [self.factory.username, self.factory.sessionToken])
+            self.state = S_RESUMESENT
+        else:
+            self.msgSend(p.T_USER, [self.factory.username])
+            self.state = S_LOGINSENT
         
     def connectionLost(self, reason):
-        pass
+        self.cancelRenew()
+        if self.keepalive.running:
+            self.keepalive.stop()
         #self.factory.handleError("Connection lost, %s" % reason)
+        if self.factory.dirProto is self:
+            self.factory.dirProto = None
+
+        # Nothing is going to answer the requests in flight
+        pending, self.pending = self.pending, deque()
+        [ self.__settle(r, DirectoryError("Connection to the directory lost")) for r in pending ]
         
-    def dataReceived(self, data):
-        try:
-            self.buffer += data
-            self.buffer, msgs = p.parse_all(self.buffer)
-    
-            for msg in msgs:
-                reactor.callLater(0, self.msgReceived, msg)
-        except:
-            # @TODO
-            # Error handling
-            pass
-            
     def msgSend(self, msgType, msgArgs =[], msgPayload = ""):
         m = p.Message(msgType, msgArgs, msgPayload)
-        self.transport.write(str(m))
+        self.transport.writeSequence(m.encode())
+
+    def request(self, msgType, msgArgs = [], msgPayload = "", timeout = None):
+        """ Send a request to the directory. Returns a Deferred fired with the ACK
+            or RESULT answering it. It fails with a DirectoryError if the directory
+            answers with an ERR, if the connection is lost or if no answer comes
+            within timeout seconds, REQUEST_TIMEOUT by default. """
+
+        if self.state != S_AUTHENTICATED:
+            return defer.fail(DirectoryError("Not logged in to the directory"))
+
+        r = PendingRequest(msgType)
+        r.timeoutCall = reactor.callLater(timeout or self.REQUEST_TIMEOUT, self.__timedOut, r)
+        self.pending.append(r)
+        self.msgSend(msgType, msgArgs, msgPayload)
+        return r.deferred
         
     def msgReceived(self, msg):
         try:
             if msg.type == p.T_PING:
                 self.msgSend(p.T_PONG)
+            elif msg.type == p.T_PONG:
+                # Answer to our keepalive
+                pass
+            elif self.state == S_RESUMESENT:
+                if msg.type == p.T_ACK:
+                    self.state = S_AUTHENTICATED
+                    self.__bound(msg)
+                    self.__subscribe()
+                else:
+                    # The token is not valid any more, log in as usual
+                    self.factory.sessionToken = None
+                    self.msgSend(p.T_USER, [self.factory.username])
+                    self.state = S_LOGINSENT
             elif self.state == S_LOGINSENT:
                 if msg.type == p.T_ACK:
                     self.msgSend(p.T_PASS, [self.factory.password])
@@ -67,43 +174,122 @@ class DirectoryProtocol(protocol.Protocol):
                     self.state = S_ERROR
             elif self.state == S_PASSSENT:
                 if msg.type == p.T_ACK:
-                    self.msgSend(p.T_BIND, [self.factory.host, self.factory.listeningPort])
                     self.state = S_AUTHENTICATED
+                    d = self.request(p.T_BIND, [self.factory.host, self.factory.listeningPort])
+                    d.addCallbacks(self.__bound, self.__requestFailed)
+                    self.__subscribe()
                 else:
                     self.state = S_ERROR
             elif self.state == S_AUTHENTICATED:
-                if msg.type == p.T_ACK:
+                if msg.type == p.T_NOTIFY and len(msg.args) == 2:
+                    # Users joined or left, keep the list current without printing it
+                    self.factory.applySync(msg)
+                elif msg.type in (p.T_ACK, p.T_RESULT, p.T_ERR):
+                    self.__answer(msg)
                     
                     # @ TODO
                     # Implement Leave State
-                    pass
-                elif msg.type == p.T_RESULT:
-                    [ self.__parseUserRecord(r) for r in msg.payload.split() ] 
-                    
-                    # @ TODO
-                    # Redirect printing to the agent for better output
-                    print "Online users:"
-                    for x in self.factory.userList:
-                        print "list:> %s, %s" % (x, self.factory.userList[x])
                 else:
                     self.state = S_ERROR
         except Exception, e:
             self.factory.handleError(e)
 
-    def __parseUserRecord(self, record):
-        """ Parse user records and store the extracted information as a tuple in a dictionary """
+    def __answer(self, msg):
+        """ Hand an answer to the oldest request in flight """
 
-        match = re.search('([a-zA-Z0-9]+),([0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}),([0-9]+)', record)
-        username = match.group(1)
-        userIp = match.group(2)
-        userPort = int(match.group(3))
-        self.factory.userList[username] = (userIp, userPort)
+        if not self.pending:
+            raise DirectoryError("Unexpected %s from the directory" % msg.type)
+
+        r = self.pending.popleft()
+        if msg.type == p.T_ERR:
+            self.__settle(r, DirectoryError(msg.payload or "%s refused" % r.msgType))
+        else:
+            self.__settle(r, msg)
+
+    def __settle(self, r, result):
+        if r.timeoutCall is not None and r.timeoutCall.active():
+            r.timeoutCall.cancel()
+
+        # A request that timed out has already failed, its late answer is dropped
+        if r.deferred.called:
+            return
+        if isinstance(result, Exception):
+            r.deferred.errback(result)
+        else:
+            r.deferred.callback(result)
+
+    def __timedOut(self, r):
+        """ Fail a request not answered in time. It stays in the queue, so that
+            its answer, if it ever comes, is not taken for the next one's. """
+
+        r.deferred.errback(DirectoryError("No answer to %s from the directory" % r.msgType))
+
+    def __keepalive(self):
+        """ Keep the session from being closed as idle. The directory only
+            accepts a PING from a logged in session. """
+
+        if self.state == S_AUTHENTICATED:
+            self.msgSend(p.T_PING)
+
+    def __requestFailed(self, failure):
+        self.factory.handleError(failure.getErrorMessage())
+
+    def __subscribe(self):
+        """ Let the directory push the users joining or leaving """
+
+        d = self.request(p.T_SUBSCRIBE, [self.factory.syncToken] if self.factory.syncToken else [])
+        d.addErrback(self.__requestFailed)
+
+    def __bound(self, msg):
+        self.__leaseGranted(msg)
+        self.factory.sessionEstablished()
+
+    def __leaseGranted(self, msg):
+        for arg in msg.args:
+            if arg.isdigit():
+                # BIND, RESUME or RENEW granted a lease, renew it halfway through
+                self.__scheduleRenew(int(arg))
+            elif arg.startswith("session="):
+                # Token to skip the login and the bind on the next connection
+                self.factory.sessionToken = arg[len("session="):]
+
+    def __scheduleRenew(self, ttl):
+        """ Send a RENEW before the lease granted by the directory expires """
+
+        self.cancelRenew()
+        self.renewCall = reactor.callLater(ttl / 2.0, self.__renew)
+
+    def cancelRenew(self):
+        """ Stop renewing the lease, e.g. once we left the directory """
+
+        if self.renewCall is not None and self.renewCall.active():
+            self.renewCall.cancel()
+        self.renewCall = None
+
+    def __renew(self):
+        self.request(p.T_RENEW).addCallbacks(self.__leaseGranted, self.__requestFailed)
+
+
+
+class PendingPeer:
+    """ A peer connection being opened: the messages to send as soon as it is
+        made, and the Deferreds waiting for it """
+
+    def __init__(self, username):
+        self.username = username
+        self.queue = []                 # (type, args, payload) of the messages to send
+        self.waiting = []               # Deferreds fired with the connection
 
 
 
 class ChatClientFactory(ClientFactory):
     """ Chat Client Factory class, handles the interaction between the user 
         and the directory server plus the chating among users."""
+
+    PAGE_SIZE = 20
+    MAX_PEERS = 64                  # Open peer connections kept at most
+    PEER_IDLE_TIMEOUT = 300         # Seconds before an unused peer connection is closed
+    CONNECT_TIMEOUT = 5             # Seconds to wait for a peer connection
     
     def __init__(self, username, password, host, listeningPort):
         self.connection=None
@@ -113,7 +299,20 @@ class ChatClientFactory(ClientFactory):
         self.listeningPort = listeningPort
         self.dirProto = None
         self.userList = {}              # Keep all the user's data (IP, PORT) in a dictonary
-        self.peerPool = []              # Keep a list of all the active peer connections and reuse them
+        self.syncToken = None           # Version of the user list, as named by the directory
+        self.sessionToken = None        # Token to resume the directory session with, once bound
+        self.browsePrefix = None        # Prefix and cursor of the last page browsed
+        self.browseCursor = None
+        self.peers = OrderedDict()      # (host, port) -> open peer connection, least recently used first
+        self.peersByName = {}           # username -> open peer connection
+        self.dialing = {}               # (host, port) -> PendingPeer, for the connections being opened
+        self.reconnect = ReconnectPolicy()
+        self.reconnectCall = None
+        self.restoredCallbacks = []     # (function, args) called when a lost session is restored
+
+        # Close the peer connections nobody used for a while
+        self.idleCheck = task.LoopingCall(self.closeIdlePeers)
+        self.idleCheck.start(self.PEER_IDLE_TIMEOUT / 10, now = False)
     
     def buildProtocol(self, address):
         """ Overriden method to distinguish between the two protocols. """
@@ -129,94 +328,287 @@ class ChatClientFactory(ClientFactory):
     def clientConnectionLost(self, connector, reason):
         #self.handleError("Lost connection, reason: %s" % reason.getErrorMessage())
         
-        #Reconnect automatically on the directory server. Keep connection alive
-        connector.connect()
+        #Reconnect automatically on the directory server. Keep connection alive.
+        #Peer connections are opened again only when needed
+        if connector.getDestination().port == 8888:
+            self.__reconnect(connector)
         
     def clientConnectionFailed(self, connector, reason):
+        destination = connector.getDestination()
+        pending = self.dialing.pop((destination.host, destination.port), None)
+        if pending is not None:
+            # The messages are dropped, the waiting Deferreds report why
+            [ d.errback(reason) for d in pending.waiting ]
+            return
         self.handleError("Connection failed, reason: %s" % reason.getErrorMessage())
         #reactor.stop()
+
+        if destination.port == 8888:
+            self.__reconnect(connector)
+
+    def sessionEstablished(self):
+        """ Called by the directory protocol once logged in and bound """
+
+        if self.reconnect.established():
+            for function, args in self.restoredCallbacks:
+                try:
+                    function(*args)
+                except Exception, e:
+                    self.handleError(e)
+
+    def addRestoredCallback(self, function, *args):
+        """ Have function(*args) called every time the session with the directory
+            is established again after being lost """
+
+        self.restoredCallbacks.append((function, args))
     
     def clientConnectionMade(self, client):
-        """ Method that adds a new peer connection to the connection list upon success """
+        """ Method that indexes a new peer connection upon success """
         
-        self.peerPool.append(client)
+        # The address dialed, as found in the user list
+        destination = client.transport.connector.getDestination()
+        client.peerKey = (destination.host, destination.port)
+        pending = self.dialing.pop(client.peerKey, None)
+        client.peerName = pending.username if pending is not None else None
+        client.lastUsed = time.time()
+
+        previous = self.peers.pop(client.peerKey, None)
+        if previous is not None:
+            self.__forgetPeer(previous)
+            previous.transport.loseConnection()
+
+        self.peers[client.peerKey] = client
+        if client.peerName is not None:
+            self.peersByName[client.peerName] = client
+
+        # Make room, closing the least recently used connections
+        while len(self.peers) > self.MAX_PEERS:
+            key, lru = self.peers.popitem(last = False)
+            self.__forgetPeer(lru)
+            lru.transport.loseConnection()
+
+        # Send what was queued while connecting, and wake up who was waiting
+        if pending is not None:
+            [ client.msgSend(*m) for m in pending.queue ]
+            [ d.callback(client) for d in pending.waiting ]
         
     def clientConnectionClosed(self, client):
-        """ Method that removes a dead peer connection from the connection list """
+        """ Method that removes a dead peer connection from the indexes """
         
-        self.peerPool.remove(client)
+        self.__forgetPeer(client)
+
+    def closeIdlePeers(self):
+        """ Close the peer connections not used for PEER_IDLE_TIMEOUT seconds """
+
+        deadline = time.time() - self.PEER_IDLE_TIMEOUT
+        while self.peers:
+            key, client = next(self.peers.iteritems())
+            if client.lastUsed >= deadline:
+                break
+            self.__forgetPeer(client)
+            client.transport.loseConnection()
     
     def listAll(self):
-        """ Send a 'list all users' query to the directory server """
-        self.dirProto.msgSend(p.T_QUERY)
+        """ Ask the directory server for the users that joined or left since the last listing.
+            Returns a Deferred fired with the user list once it is up to date. """
+
+        d = self.__request(p.T_SYNC, [self.syncToken] if self.syncToken else [])
+        return d.addCallback(self.__synced)
     
+    def browse(self, prefix = ""):
+        """ Ask for the first page of the users whose name starts with prefix.
+            Returns a Deferred fired with the (username, (ip, port)) of the page. """
+
+        self.browsePrefix = prefix
+        self.browseCursor = None
+        return self.__browse(["prefix=%s" % prefix, "limit=%d" % self.PAGE_SIZE])
+
+    def browseMore(self):
+        """ Ask for the next page of the last browsed users """
+
+        if self.browseCursor is None:
+            return defer.fail(DirectoryError("No more users to show"))
+        return self.__browse(["prefix=%s" % self.browsePrefix, "limit=%d" % self.PAGE_SIZE, "after=%s" % self.browseCursor])
+
     def search(self, user):
-        """ Search for a specific user """
+        """ Look up a specific user. Returns a Deferred fired with its (ip, port),
+            or None if it is not online. Any number of lookups can be in flight. """
         
-        self.dirProto.msgSend(p.T_QUERY, [user])
+        return self.__request(p.T_QUERY, [user]).addCallback(self.__found, user)
         
     def leave(self):
-        self.dirProto.msgSend(p.T_LEAVE,[])
-        
-    def chat(self, username, message = "Dummy"):
-        """ Start chatting with a specific user """
+        """ Deregister from the directory. Returns a Deferred fired once done. """
 
-        try:
-            if len(self.userList) == 0:
-                raise Exception, 'Use the list command to get the online users'
-
-            if (username in self.userList):
-                uIp, uPort = self.userList[username]
-                uConn = self.__searchOpenPeers((uIp, uPort))
-                if len(self.peerPool) == 0 or uConn is None:
-                    reactor.connectTCP( uIp, uPort, self)
-                    
-                    # Quick and dirty solution to wait 1 sec until the connection is setup
-                    # The right one is to use deferreds!
-                    reactor.callLater(1,self.chat, username, message)
-                else:
-                    uConn.msgSend(p.T_MESSAGE, [self.username], message)
+        self.sessionToken = None
+        # A RENEW after the LEAVE would be refused, and the session closed. The
+        # answer to a RENEW already sent may schedule another one, cancel it too
+        if self.dirProto is not None:
+            self.dirProto.cancelRenew()
+        return self.__request(p.T_LEAVE).addCallback(self.__left)
+
+    def __left(self, msg):
+        if self.dirProto is not None:
+            self.dirProto.cancelRenew()
+        return msg
 
-            else:
-                raise Exception, 'User %s can\'t be reached.' % username
+    def applySync(self, msg):
+        """ Apply a SYNC result or a NOTIFY: the full list or the changes since our version """
 
-        except Exception,e:
-            self.handleError(e)
+        self.syncToken, mode = msg.args
+        if mode == 'full':
+            self.userList.clear()
+        [ self.__applyUserChange(r) for r in msg.payload.split() ]
+        
+    def chat(self, username, message = "Dummy"):
+        """ Start chatting with a specific user, looked up first if not known yet """
+
+        d = self.__resolve(username)
+        d.addCallback(self.sendToPeer, p.T_MESSAGE, [self.username], message)
+        return d.addErrback(self.__peerUnreachable, username)
             
     def ping(self, username):
-        """ Ping a specific user """
+        """ Ping a specific user, looked up first if not known yet """
 
-        try:
-            if len(self.userList) == 0:
-                raise Exception, 'Use the list command to get the online users'
-
-            if (username in self.userList):
-                uIp, uPort = self.userList[username]
-                uConn = self.__searchOpenPeers((uIp, uPort))
-                
-                if len(self.peerPool) == 0 or uConn is None:
-                    reactor.connectTCP( uIp, uPort, self)
-                    
-                    # Same quick and dirty solution here
-                    reactor.callLater(1,self.ping, username)
-                else:
-                    uConn.msgSend(p.T_PING, [self.username])
-            else:
-                raise Exception, 'User %s can\'t be reached.' % username
-
-        except Exception,e:
-            self.handleError(e)
+        d = self.__resolve(username)
+        d.addCallback(self.sendToPeer, p.T_PING, [self.username])
+        return d.addErrback(self.__peerUnreachable, username)
     
-    def __searchOpenPeers(self, (host, port)):
-        """ Search if there is an active connection for the specific user (IP, PORT). """
+    def connectPeer(self, username):
+        """ Return a Deferred fired with the connection to a user, opened on demand.
+            It fails if the connection can't be made within CONNECT_TIMEOUT. """
+
+        client = self.__findPeer(username)
+        if client is not None:
+            return defer.succeed(client)
+
+        d = defer.Deferred()
+        self.__dial(username).waiting.append(d)
+        return d
+
+    def sendToPeer(self, username, msgType, msgArgs = [], msgPayload = ""):
+        """ Send a message to a user. If the connection is still being opened, the
+            message is queued and sent as soon as it is made. Returns a Deferred fired
+            with the connection once the message is sent. """
+
+        client = self.__findPeer(username)
+        if client is not None:
+            client.msgSend(msgType, msgArgs, msgPayload)
+            return defer.succeed(client)
+
+        pending = self.__dial(username)
+        pending.queue.append((msgType, msgArgs, msgPayload))
+        d = defer.Deferred()
+        pending.waiting.append(d)
+        return d
+
+    def __reconnect(self, connector):
+        """ Connect again to the directory after a random, growing delay """
+
+        if self.reconnectCall is not None and self.reconnectCall.active():
+            return
+        self.reconnectCall = reactor.callLater(self.reconnect.nextDelay(), connector.connect)
+
+    def __request(self, msgType, msgArgs = []):
+        if self.dirProto is None:
+            return defer.fail(DirectoryError("Not connected to the directory"))
+        return self.dirProto.request(msgType, msgArgs)
+
+    def __synced(self, msg):
+        self.applySync(msg)
+        return self.userList
+
+    def __browse(self, args):
+        return self.__request(p.T_QUERY, args).addCallback(self.__page)
+
+    def __page(self, msg):
+        """ One page of a find: keep the cursor of the next page """
+
+        if len(msg.args) == 1 and msg.args[0].startswith("next="):
+            self.browseCursor = msg.args[0][len("next="):] or None
+        return [ self.__parseUserRecord(r) for r in msg.payload.split() ]
+
+    def __found(self, msg, user):
+        found = dict([ self.__parseUserRecord(r) for r in msg.payload.split() ])
+        if user not in found:
+            # Forget a user that left without us being notified
+            self.userList.pop(user, None)
+        return found.get(user)
+
+    def __resolve(self, username):
+        """ Return a Deferred fired with the username once its address is known """
+
+        if username in self.userList:
+            return defer.succeed(username)
+        return self.search(username).addCallback(self.__resolved, username)
+
+    def __resolved(self, address, username):
+        if address is None:
+            raise DirectoryError("User %s is not online" % username)
+        return username
+
+    def __applyUserChange(self, record):
+        """ Apply one line of a SYNC result: '-username' for a user that left,
+            a user record, optionally prefixed by '+', otherwise """
+
+        if record.startswith('-'):
+            self.userList.pop(record[1:], None)
+        else:
+            self.__parseUserRecord(record.lstrip('+'))
+
+    def __parseUserRecord(self, record):
+        """ Parse user records and store the extracted information as a tuple in a dictionary.
+            Returns the username and its (ip, port). """
+
+        match = re.search('([a-zA-Z0-9]+),([0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}),([0-9]+)', record)
+        username = match.group(1)
+        userIp = match.group(2)
+        userPort = int(match.group(3))
+        self.userList[username] = (userIp, userPort)
+        return username, self.userList[username]
+
+    def __dial(self, username):
+        """ Start opening the connection to a user, unless already in progress """
+
+        address = self.userList[username]
+        pending = self.dialing.get(address)
+        if pending is None:
+            pending = self.dialing[address] = PendingPeer(username)
+            reactor.connectTCP(address[0], address[1], self, timeout = self.CONNECT_TIMEOUT)
+        return pending
+
+    def __peerUnreachable(self, failure, username):
+        self.handleError("User %s can't be reached: %s" % (username, failure.getErrorMessage()))
+
+    def __findPeer(self, username):
+        """ Return the open connection to a user, marking it as the most recently used,
+            or None if there is none """
         
-        for client in self.peerPool:
-            cHost = client.transport.getPeer().host
-            cPort = client.transport.getPeer().port
+        address = self.userList[username]
+        client = self.peersByName.get(username)
+        if client is None or client.peerKey != address:
+            # Not opened by name, or the user bound somewhere else since
+            client = self.peers.get(address)
+
+        if client is None:
+            return None
+
+        del self.peers[client.peerKey]
+        self.peers[client.peerKey] = client
+        client.lastUsed = time.time()
+        if client.peerName != username:
+            self.__forgetPeer(client)
+            client.peerName = username
+            self.peers[client.peerKey] = client
+            self.peersByName[username] = client
+        return client
+
+    def __forgetPeer(self, client):
+        """ Remove a peer connection from the indexes, if it is still there """
 
-            if cHost is host and cPort == port:
-                return client
-        return None
+        if self.peers.get(client.peerKey) is client:
+            del self.peers[client.peerKey]
+        if client.peerName is not None and self.peersByName.get(client.peerName) is client:
+            del self.peersByName[client.peerName]
     
     def handleError(self, errorMsg):
         # @TODO send data back to agent throung transport, with defered
@@ -9,17 +9,42 @@
 # @description  : Eurechat peer protocol implementation and listening server based on twisted python
 #
 
-from twisted.internet import protocol, reactor
+from twisted.internet import protocol
+from twisted.python import log
 
 import parsing as p
 
 
 
-class PeerProtocol(protocol.Protocol):
+class MessageProtocol(protocol.Protocol):
+    """ Decodes the received data into messages and hands them to msgReceived.
+        All the messages completed by one read are dispatched right away, in
+        order, and a message whose handler fails doesn't prevent the following
+        ones from being handled. Subclasses set self.decoder to a StreamDecoder
+        once connected, and define msgReceived(msg). """
+
+    def dataReceived(self, data):
+        try:
+            messages = self.decoder.feed(data)
+        except p.ParseError, e:
+            # The stream can't be framed any more, nothing after this can be trusted
+            log.msg("Dropping %s: %s" % (self.transport.getPeer(), e))
+            self.transport.loseConnection()
+            return
+
+        for msg in messages:
+            try:
+                self.msgReceived(msg)
+            except:
+                log.err(None, "Handling %s message failed" % msg.type)
+
+
+class PeerProtocol(MessageProtocol):
     """ Implementing Eurechat peer protocol between users. """
     
     def connectionMade(self):
-        self.buffer = ""
+        self.transport.setTcpNoDelay(True)
+        self.decoder = p.StreamDecoder()
         
         # If the peer protocol is trigger by the client factory we add the
         # instance in the active peer connection list
@@ -33,22 +58,9 @@ class PeerProtocol(protocol.Protocol):
         if not isinstance(self.factory, ChatServerFactory):
             self.factory.clientConnectionClosed(self)
             
-    def dataReceived(self, data):
-        try:
-            self.buffer += data
-            self.buffer, msgs = p.parse_all(self.buffer)
-    
-            for msg in msgs:
-                reactor.callLater(0, self.msgReceived, msg)
-        
-        except:
-            # @TODO
-            # Error handling
-            pass
-            
     def msgSend(self, msgType, msgArgs =[], msgPayload = ""):
         m = p.Message(msgType, msgArgs, msgPayload)
-        self.transport.write(str(m))
+        self.transport.writeSequence(m.encode())
         
     def msgReceived(self, msg):
         """ Function that handles incomind messages and Ping pongs """
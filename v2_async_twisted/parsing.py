@@ -11,7 +11,6 @@ Corrado Leita - corrado_leita@symantec.com
 ================================================
 Simple message parser
 '''
-import re
 
 # === Definition of the message types ===
 
@@ -23,10 +22,26 @@ T_PASS="PASS"
 T_BIND="BIND"
 #used by a user to notify its intention to leave the chat and undo the binding
 T_LEAVE="LEAVE"
+#used by a bound user to renew the lease granted by the directory on BIND
+T_RENEW="RENEW"
+#sent instead of USER by a user that was bound before, to log in and
+#restore its binding in one round trip. The arguments are the username
+#and the session token returned with the ACK of the BIND. If the token
+#is not valid any more, the directory answers with an ERR and the user
+#must log in with USER and PASS on the same connection
+T_RESUME="RESUME"
 #command to query the directory service. An optional argument cna be
 #used to query the directory service for a specific user. Providing
 #no arguments will generate a list of all users
 T_QUERY="QUERY"
+#command to keep a copy of the user list up to date. The optional argument
+#is the version token returned with the previous RESULT: if the directory
+#still remembers that version, only the users that joined or left since
+#then are returned, otherwise the whole list is
+T_SYNC="SYNC"
+#used by an authenticated user to receive the users joining or leaving the
+#directory. The optional argument is a version token, as for SYNC
+T_SUBSCRIBE="SUBSCRIBE"
 #sent by the server to ack the reception and successful completion
 #of a command that does not expect any result (USER or PASS)
 T_ACK="ACK"
@@ -35,6 +50,9 @@ T_ERR="ERR"
 #sent by the server in response to a command that expects some result
 #in return. The result is in the payload of the message.
 T_RESULT="RESULT"
+#pushed by the server to the subscribed users. It carries a version token
+#and the changes since the previous one, in the same format as a SYNC result
+T_NOTIFY="NOTIFY"
 #keep alive messages, to verify the correct operation of a client.
 #any client must respond to a PING message with a PONG
 T_PING="PING"
@@ -44,6 +62,41 @@ T_PONG="PONG"
 #as payload
 T_MESSAGE="MESSAGE"
 
+#known message types. Parsed types are looked up here, so that they
+#are the very same string objects as the constants above
+TYPES=dict((t,t) for t in (T_USER,T_PASS,T_BIND,T_LEAVE,T_RENEW,T_RESUME,T_QUERY,T_SYNC,
+                           T_SUBSCRIBE,T_ACK,T_ERR,T_RESULT,T_NOTIFY,T_PING,
+                           T_PONG,T_MESSAGE))
+
+
+def parse_header(line):
+    """
+    Split a header line, without its trailing newline, into the
+    message type, the payload length and the list of arguments.
+    Fields are separated by exactly one space, the type is made of
+    alphanumeric characters and the length of digits.
+    Returns None if the line is malformed.
+    """
+    #fields must be separated by single spaces, with no other
+    #whitespace around or inside them
+    fields=line.split()
+    if len(fields)<2 or " ".join(fields)!=line:
+        return None
+
+    m_type=TYPES.get(fields[0])
+    if m_type==None:
+        #not a known type, but still a valid one
+        m_type=fields[0]
+        if not m_type.replace("_","a").isalnum():
+            return None
+
+    m_len=fields[1]
+    if not m_len.isdigit():
+        return None
+
+    return m_type,int(m_len),fields[2:]
+
+
 def parse(buf):
     """
     Tries to extract one message from a string buffer.
@@ -82,6 +135,138 @@ def parse_all(buf):
     return toparse,parsed
 
 
+#buffers shorter than this are copied together into one write,
+#longer ones are written on their own
+GATHER_SIZE=8192
+
+def gather(buffers):
+    """
+    Turn a sequence of buffers, such as the ones returned by
+    Message.encode, into the chunks to be written on a socket.
+    Consecutive short buffers are joined, so that they do not cost
+    a system call each, while long payloads are passed as they
+    are, without copying them.
+    """
+    chunks=[]
+    short=[]
+    for b in buffers:
+        if len(b)<GATHER_SIZE:
+            short.append(b)
+            continue
+        if short:
+            chunks.append(short[0] if len(short)==1 else "".join(map(str,short)))
+            short=[]
+        chunks.append(b)
+    if short:
+        chunks.append(short[0] if len(short)==1 else "".join(map(str,short)))
+    return chunks
+
+
+class ParseError(Exception):
+    """
+    Raised by StreamDecoder when the received stream does not
+    follow the protocol syntax
+    """
+    pass
+
+
+class StreamDecoder:
+    """
+    Incremental decoder for a stream of messages, to be fed with
+    the data received from a connection. The data is appended to a
+    bytearray and consumed by moving a read offset, so the remainder
+    is not copied at every chunk, and the search for the end of a
+    header resumes where it stopped. Every payload is copied exactly
+    once, out of a memoryview of the buffer.
+    """
+    #longest accepted header line
+    MAX_HEADER=4096
+    #consumed bytes are dropped from the buffer once they exceed this size
+    COMPACT_SIZE=65536
+
+    def __init__(self):
+        self.__buffer=bytearray()
+        #start of the first message not decoded yet
+        self.__offset=0
+        #position from which the search for the header newline resumes
+        self.__scan=0
+        #(type,args,payload start,payload end) of the message whose
+        #header was decoded, while its payload is not complete yet
+        self.__header=None
+
+    def feed(self,data):
+        """
+        Append received data to the buffer. Returns the list of
+        messages that were completed, possibly empty. Raises a
+        ParseError if the stream is not made of valid messages.
+        """
+        self.__buffer.extend(data)
+
+        messages=[]
+        m=self.__next()
+        while m!=None:
+            messages.append(m)
+            m=self.__next()
+
+        self.__compact()
+        return messages
+
+    def buffered(self):
+        """
+        Number of received bytes that are not part of a decoded message yet
+        """
+        return len(self.__buffer)-self.__offset
+
+    def __next(self):
+        """
+        Decode the next message, or return None if it is not complete
+        """
+        buf=self.__buffer
+
+        if self.__header==None:
+            nl=buf.find("\n",self.__scan)
+            if nl<0:
+                self.__scan=len(buf)
+                if len(buf)-self.__offset>StreamDecoder.MAX_HEADER:
+                    raise ParseError("header line too long")
+                return None
+
+            header=parse_header(memoryview(buf)[self.__offset:nl].tobytes())
+            if header==None:
+                raise ParseError("malformed header")
+
+            m_type,m_len,m_args=header
+            start=nl+1
+            self.__header=(m_type,m_args,start,start+m_len)
+
+        m_type,m_args,start,end=self.__header
+        if len(buf)<end:
+            #wait for the rest of the payload
+            return None
+
+        payload=memoryview(buf)[start:end].tobytes()
+        self.__header=None
+        self.__offset=self.__scan=end
+        return Message(m_type,m_args,payload)
+
+    def __compact(self):
+        """
+        Drop the consumed bytes, when it is cheap or when they pile up
+        """
+        if self.__offset==len(self.__buffer):
+            del self.__buffer[:]
+        elif self.__offset>=StreamDecoder.COMPACT_SIZE:
+            del self.__buffer[:self.__offset]
+            self.__scan-=self.__offset
+            if self.__header!=None:
+                m_type,m_args,start,end=self.__header
+                self.__header=(m_type,m_args,start-self.__offset,end-self.__offset)
+        else:
+            return
+        self.__offset=0
+        self.__scan=min(self.__scan,len(self.__buffer))
+
+
 class Message:
     
     def __init__(self,message_type=None,message_args=[],message_payload=""):
@@ -109,17 +294,14 @@ class Message:
         #number of consumed bytes
         consumed=0
         
-        #use this regular expression to parse the header
-        #If you are not familiar with regular expressions, have
-        #a look to the following page: http://docs.python.org/library/re.html
-        match=re.match("(?P<type>\w+) (?P<len>\d+)(?P<args>( \S+)*)\n",buf)
-        if match:
+        #the header ends with the first newline: if there is none,
+        #it was not received completely yet
+        nl=buf.find("\n")
+        header=parse_header(buf[:nl]) if nl>=0 else None
+        if header:
             #the header was parsed correctly
-            hlen=match.end() #last character matched by the regular expression
-            m_type=match.groupdict()["type"]
-            m_len=int(match.groupdict()["len"])
-            m_args=[i for i in match.groupdict()["args"].strip().split(" ") if len(i)>0]
-            
+            hlen=nl+1
+            m_type,m_len,m_args=header
             
             if len(buf)>=hlen+m_len:
                 #all the payload is there.
@@ -134,14 +316,23 @@ class Message:
         return consumed
             
         
-    def __str__(self):
+    def encode(self):
         """
-        Create the message
+        Create the message as a list of buffers: the header line,
+        followed by the payload if there is one. Unlike str(), the
+        payload is not copied.
         """
         if len(self.args):
-            return "%s %d %s\n"%(self.type,len(self.payload)," ".join(map(str,self.args)))+self.payload
+            header="%s %d %s\n"%(self.type,len(self.payload)," ".join(map(str,self.args)))
         else:
-            return "%s %d\n"%(self.type,len(self.payload))+self.payload
+            header="%s %d\n"%(self.type,len(self.payload))
+        return [header,self.payload] if self.payload else [header]
+    
+    def __str__(self):
+        """
+        Create the message
+        """
+        return "".join(self.encode())
     
     def __repr__(self):
         """